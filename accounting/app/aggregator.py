@@ -0,0 +1,183 @@
+from contextlib import suppress
+from typing import Optional
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
+from aiokafka.structs import ConsumerRecord, TopicPartition
+from app.events import UndecodableEvent
+from app.ledger import Ledger
+from app.metrics import KAFKA_CONSUMER_LAG
+from prometheus_client import Counter, Histogram
+from app.publisher import EventPublisher
+from app.repository import SnapshotRepository
+from time import perf_counter
+import asyncio
+import logging
+import os
+
+TRANSACTIONS_APPLIED = Counter(
+    "accounting_transactions_total", "Transactions applied to balances", ["type"]
+)
+SNAPSHOT_SECONDS = Histogram(
+    "accounting_snapshot_duration_seconds", "Time spent writing a balance snapshot"
+)
+
+TRANSACTIONS_TOPIC = "transactions"
+
+CONSUMER_BATCH_SIZE = int(os.getenv("TASK_CONSUMER_BATCH_SIZE", "1000"))
+CONSUMER_TIMEOUT_MS = int(os.getenv("TASK_CONSUMER_TIMEOUT_MS", "1000"))
+SNAPSHOT_INTERVAL = float(os.getenv("BALANCE_SNAPSHOT_INTERVAL_SECONDS", "5"))
+
+
+class BalanceAggregator:
+    def __init__(
+        self,
+        consumer: AIOKafkaConsumer,
+        ledger: Ledger,
+        snapshot_repo: SnapshotRepository,
+        publisher: EventPublisher,
+        saved_offsets: dict[tuple[str, int], int],
+        batch_size: int = CONSUMER_BATCH_SIZE,
+        timeout_ms: int = CONSUMER_TIMEOUT_MS,
+        snapshot_interval: float = SNAPSHOT_INTERVAL,
+        retry_seconds: float = 1,
+    ):
+        self.consumer = consumer
+        self.ledger = ledger
+        self.snapshot_repo = snapshot_repo
+        self.publisher = publisher
+        self.saved_offsets = dict(saved_offsets)
+        self.batch_size = batch_size
+        self.timeout_ms = timeout_ms
+        self.snapshot_interval = snapshot_interval
+        self.retry_seconds = retry_seconds
+        self._positions: dict[tuple[str, int], int] = {}
+        # Held while a batch is applied so a snapshot never sees half of one
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        await self.snapshot()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_snapshot = loop.time() + self.snapshot_interval
+        while True:
+            try:
+                await self.consume()
+            except Exception:
+                logging.exception("Failed to consume task events, retrying")
+                await asyncio.sleep(self.retry_seconds)
+            if loop.time() >= next_snapshot:
+                try:
+                    await self.snapshot()
+                except Exception:
+                    logging.exception("Failed to snapshot balances, will retry")
+                next_snapshot = loop.time() + self.snapshot_interval
+
+    async def consume(self):
+        batches = await self.consumer.getmany(
+            timeout_ms=self.timeout_ms, max_records=self.batch_size
+        )
+        async with self._lock:
+            for tp, records in batches.items():
+                highwater = self.consumer.highwater(tp)
+                if highwater is not None:
+                    KAFKA_CONSUMER_LAG.labels(tp.topic, tp.partition).set(
+                        highwater - records[-1].offset - 1
+                    )
+                for record in records:
+                    if record.value is None:
+                        continue
+                    if isinstance(record.value, UndecodableEvent):
+                        await self.dead_letter(tp, record)
+                        continue
+                    try:
+                        await self.apply(record.value)
+                    except Exception:
+                        # Retrying would fail the same way and stall the topic
+                        logging.exception(
+                            f"Skipping task event {tp.topic}:{tp.partition}"
+                            f"@{record.offset}"
+                        )
+                self._positions[(tp.topic, tp.partition)] = records[-1].offset + 1
+
+    async def dead_letter(self, tp: TopicPartition, record: ConsumerRecord):
+        while True:
+            try:
+                await self.publisher.dead_letter(tp.topic, record.key, record.value)
+                return
+            except Exception:
+                # The partition waits, an undecodable event is never committed
+                # past before it is kept in the dead-letter topic
+                logging.exception("Failed to dead-letter task event, retrying")
+                await asyncio.sleep(self.retry_seconds)
+
+    async def apply(self, event: dict):
+        transaction = self.ledger.apply(event)
+        if transaction is None:
+            return
+        TRANSACTIONS_APPLIED.labels(transaction["type"]).inc()
+        await self.publisher.publish(
+            TRANSACTIONS_TOPIC,
+            {
+                "event_type": "transaction_created",
+                # Stable across replays so consumers can drop duplicates
+                "event_id": transaction["transaction_id"],
+                "payload": transaction,
+            },
+            key=transaction["account_id"],
+        )
+
+    async def snapshot(self):
+        async with self._lock:
+            offsets = {
+                key: offset
+                for key, offset in self._positions.items()
+                if self.saved_offsets.get(key) != offset
+            }
+            changes, rewarded = self.ledger.take_changes()
+            if not offsets and not changes and not rewarded:
+                return
+            started = perf_counter()
+            try:
+                await self.snapshot_repo.save_snapshot(changes, rewarded, offsets)
+            except BaseException:
+                self.ledger.restore_changes(changes, rewarded)
+                raise
+            SNAPSHOT_SECONDS.observe(perf_counter() - started)
+            self.saved_offsets.update(offsets)
+        # Kafka offsets only follow the snapshot, the database copy is the one
+        # a restart resumes from
+        await self.consumer.commit(
+            {
+                TopicPartition(topic, partition): offset
+                for (topic, partition), offset in offsets.items()
+            }
+        )
+        logging.info(
+            f"Snapshot of {len(changes)} balances at offsets {offsets} "
+            f"in {perf_counter() - started:.3f}s"
+        )
+
+
+class SnapshotRebalanceListener(ConsumerRebalanceListener):
+    def __init__(self, aggregator: BalanceAggregator):
+        self.aggregator = aggregator
+
+    async def on_partitions_revoked(self, revoked):
+        with suppress(Exception):
+            await self.aggregator.snapshot()
+
+    async def on_partitions_assigned(self, assigned):
+        # Resume from the snapshot, not the group offsets, so balances and
+        # positions always match
+        for tp in assigned:
+            offset = self.aggregator.saved_offsets.get((tp.topic, tp.partition))
+            if offset is not None:
+                self.aggregator.consumer.seek(tp, offset)
@@ -0,0 +1,79 @@
+from typing import Optional
+import uuid
+import zlib
+
+ASSIGNMENT_FEE_RANGE = (10, 20)
+COMPLETION_REWARD_RANGE = (20, 40)
+
+# Namespace for transaction ids derived from the event that caused them
+TRANSACTION_NAMESPACE = uuid.UUID("6f1c2a9e-5b0d-4c8e-9a7f-3d2e1b0c4a5f")
+
+
+def task_price(task_id: str, kind: str, price_range: tuple[int, int]) -> int:
+    # Prices are derived from the task id instead of being stored, so replaying
+    # the topics after a restart charges exactly the same amounts
+    low, high = price_range
+    return low + zlib.crc32(f"{task_id}:{kind}".encode("utf-8")) % (high - low + 1)
+
+
+class Ledger:
+    """Per-account balances materialized from task events. Balances that
+    changed since the last snapshot are tracked so only they are written.
+    Rewarded task ids are kept too, so a task is only ever rewarded once."""
+
+    def __init__(
+        self,
+        balances: Optional[dict[int, int]] = None,
+        rewarded: Optional[set[str]] = None,
+    ):
+        self.balances: dict[int, int] = dict(balances or {})
+        self.rewarded: set[str] = set(rewarded or ())
+        self._dirty: set[int] = set()
+        self._new_rewarded: set[str] = set()
+
+    def balance(self, account_id: int) -> int:
+        return self.balances.get(account_id, 0)
+
+    def apply(self, event: dict) -> Optional[dict]:
+        payload = event["payload"]
+        task_id = payload["task_id"]
+        if event["event_type"] == "task_assigned":
+            kind = "fee"
+            amount = -task_price(task_id, kind, ASSIGNMENT_FEE_RANGE)
+            # Every assignment, shuffles included, is charged
+            transaction_key = str(event["event_id"])
+        elif event["event_type"] == "task_completed":
+            if task_id in self.rewarded:
+                return None
+            kind = "reward"
+            amount = task_price(task_id, kind, COMPLETION_REWARD_RANGE)
+            transaction_key = f"{task_id}:{kind}"
+            self.rewarded.add(task_id)
+            self._new_rewarded.add(task_id)
+        else:
+            # task_created is followed by its own task_assigned, which is the
+            # one that charges the fee
+            return None
+        account_id = int(payload["assigned_to"])
+        self.balances[account_id] = self.balance(account_id) + amount
+        self._dirty.add(account_id)
+        return {
+            "transaction_id": str(uuid.uuid5(TRANSACTION_NAMESPACE, transaction_key)),
+            "account_id": account_id,
+            "task_id": task_id,
+            "type": kind,
+            "amount": amount,
+            "balance": self.balances[account_id],
+        }
+
+    def take_changes(self) -> tuple[dict[int, int], set[str]]:
+        changes = {account_id: self.balances[account_id] for account_id in self._dirty}
+        rewarded = self._new_rewarded
+        self._dirty = set()
+        self._new_rewarded = set()
+        return changes, rewarded
+
+    def restore_changes(self, changes: dict[int, int], rewarded: set[str]):
+        # A snapshot that failed to save is retried with the next one
+        self._dirty.update(changes)
+        self._new_rewarded.update(rewarded)
@@ -0,0 +1,83 @@
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, Request
+import app.database as db
+import app.models  # noqa: F401
+from app.aggregator import BalanceAggregator, SnapshotRebalanceListener
+from app.engine import pool_stats, warm_pool
+from app.events import decode_event
+from app.health import router as health_router
+from app.ledger import Ledger
+from app.metrics import MetricsMiddleware, metrics_response
+from app.publisher import EventPublisher
+from app.repository import SnapshotRepository
+from aiokafka import AIOKafkaConsumer
+import os
+
+task_topics = ["tasks", "task-stream"]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db.create_tables()
+    await warm_pool(db.engine)
+
+    snapshotRepo = SnapshotRepository(db.AsyncSession)
+    ledger = Ledger(
+        await snapshotRepo.load_balances(), await snapshotRepo.load_rewarded()
+    )
+    app.state.ledger = ledger
+
+    publisher = EventPublisher(os.environ.get("KAFKA_BOOTSTRAP_SERVERS"))
+    await publisher.start()
+
+    consumer = AIOKafkaConsumer(
+        bootstrap_servers=os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
+        group_id="accounting",
+        enable_auto_commit=False,
+        auto_offset_reset="earliest",
+        value_deserializer=decode_event,
+    )
+    await consumer.start()
+    aggregator = BalanceAggregator(
+        consumer, ledger, snapshotRepo, publisher, await snapshotRepo.load_offsets()
+    )
+    consumer.subscribe(task_topics, listener=SnapshotRebalanceListener(aggregator))
+    await aggregator.start()
+
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        await aggregator.stop()
+        await consumer.stop()
+        await publisher.stop()
+
+
+router = APIRouter()
+
+
+@router.get("/balances/{account_id}")
+async def get_balance(account_id: int, request: Request):
+    return {
+        "account_id": account_id,
+        "balance": request.app.state.ledger.balance(account_id),
+    }
+
+
+@router.get("/db/pool")
+async def get_pool_stats():
+    return pool_stats(db.engine)
+
+
+@router.get("/metrics")
+async def metrics():
+    return metrics_response(db.engine)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(health_router)
+    app.include_router(router)
+    return app
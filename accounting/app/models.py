@@ -0,0 +1,27 @@
+from app.database import Base
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime
+import datetime
+
+
+class Balance(Base):
+    __tablename__ = "balances"
+
+    account_id = Column(Integer, primary_key=True)
+    balance = Column(BigInteger, default=0)
+    updated_at = Column(
+        DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow
+    )
+
+
+class ConsumerOffset(Base):
+    __tablename__ = "consumer_offsets"
+
+    topic = Column(String(100), primary_key=True)
+    partition = Column(Integer, primary_key=True)
+    offset = Column(BigInteger)
+
+
+class RewardedTask(Base):
+    __tablename__ = "rewarded_tasks"
+
+    task_id = Column(String(36), primary_key=True)
@@ -0,0 +1,83 @@
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+from app.metrics import instrument_repository
+from app.models import Balance, ConsumerOffset, RewardedTask
+import datetime
+
+
+@instrument_repository
+class SnapshotRepository:
+    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
+        self.async_session = async_session
+
+    async def load_balances(self) -> dict[int, int]:
+        async with self.async_session() as session:
+            result = await session.execute(select(Balance.account_id, Balance.balance))
+            return dict(result.all())
+
+    async def load_rewarded(self) -> set[str]:
+        async with self.async_session() as session:
+            result = await session.execute(select(RewardedTask.task_id))
+            return set(result.scalars().all())
+
+    async def load_offsets(self) -> dict[tuple[str, int], int]:
+        async with self.async_session() as session:
+            result = await session.execute(
+                select(
+                    ConsumerOffset.topic,
+                    ConsumerOffset.partition,
+                    ConsumerOffset.offset,
+                )
+            )
+            return {(topic, partition): offset for topic, partition, offset in result}
+
+    async def save_snapshot(
+        self,
+        balances: dict[int, int],
+        rewarded: set[str],
+        offsets: dict[tuple[str, int], int],
+    ):
+        # Balances and the offsets they were computed up to are written in one
+        # transaction, so a restart resumes from a consistent point
+        async with self.async_session() as session:
+            if balances:
+                query = insert(Balance).values(
+                    [
+                        {
+                            "account_id": account_id,
+                            "balance": balance,
+                            "updated_at": datetime.datetime.utcnow(),
+                        }
+                        for account_id, balance in balances.items()
+                    ]
+                )
+                await session.execute(
+                    query.on_conflict_do_update(
+                        index_elements=[Balance.account_id],
+                        set_={
+                            "balance": query.excluded.balance,
+                            "updated_at": query.excluded.updated_at,
+                        },
+                    )
+                )
+            if rewarded:
+                await session.execute(
+                    insert(RewardedTask)
+                    .values([{"task_id": task_id} for task_id in rewarded])
+                    .on_conflict_do_nothing(index_elements=[RewardedTask.task_id])
+                )
+            if offsets:
+                query = insert(ConsumerOffset).values(
+                    [
+                        {"topic": topic, "partition": partition, "offset": offset}
+                        for (topic, partition), offset in offsets.items()
+                    ]
+                )
+                await session.execute(
+                    query.on_conflict_do_update(
+                        index_elements=[ConsumerOffset.topic, ConsumerOffset.partition],
+                        set_={"offset": query.excluded.offset},
+                    )
+                )
+            await session.commit()
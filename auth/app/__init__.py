@@ -0,0 +1,7 @@
+from pathlib import Path
+
+# Modules every service uses (cache, engine, events, health, metrics, publisher,
+# uow and the event schemas) live once in shared/app; images copy them into app/
+# at build time, and outside a container the package also looks them up in the
+# checkout
+__path__.append(str(Path(__file__).resolve().parents[2] / "shared" / "app"))
@@ -0,0 +1,11 @@
+from typing import NamedTuple
+
+
+class AccountRecord(NamedTuple):
+    public_id: str
+    username: str
+    role: str
+
+
+# Cached in place of an account that does not exist
+NOT_FOUND = object()
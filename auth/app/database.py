@@ -1,8 +1,9 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-import asyncio
+from app.engine import create_engine, upgrade_schema
+from app.metrics import instrument_engine
 import os
-import logging
 
 # Get the database connection configuration from environment variables
 db_user = os.getenv("POSTGRES_USER")
@@ -11,26 +12,43 @@ db_host = os.getenv("POSTGRES_HOST")
 db_port = os.getenv("POSTGRES_PORT")
 db_name = os.getenv("POSTGRES_DB")
 
-# Create the database connection URL
-db_url = f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-
-print(f"Database URL: {db_url}")
-
+# Create the database connection URL, DATABASE_URL overrides the parts above
+db_url = (
+    os.getenv("DATABASE_URL")
+    or f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+)
 
 # Create the SQLAlchemy engine
-engine = create_async_engine(db_url)
+engine = create_engine(db_url)
+instrument_engine(engine)
 
 # Create a session factory
-AsyncSession = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSession = async_sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
 
 Base = declarative_base()
 
 
+# Arbitrary ids of the advisory locks taken while creating tables and while
+# relaying the outbox
+CREATE_TABLES_LOCK = 4242
+OUTBOX_RELAY_LOCK = 4244
+
+
 # Create the database tables
 async def create_tables():
     async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Workers starting together would otherwise race on CREATE TABLE
+            await conn.execute(
+                text("SELECT pg_advisory_xact_lock(:lock)"),
+                {"lock": CREATE_TABLES_LOCK},
+            )
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(upgrade_schema, Base.metadata)
 
 
-# Run the create_tables function
-asyncio.create_task(create_tables())
+async def check_connection():
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
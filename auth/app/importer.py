@@ -0,0 +1,80 @@
+from itertools import islice
+from typing import AsyncIterator, BinaryIO, Iterator
+from fastapi.concurrency import run_in_threadpool
+from app.models import Role
+import csv
+import io
+import json
+import os
+
+IMPORT_CHUNK_SIZE = int(os.getenv("ACCOUNT_IMPORT_CHUNK_SIZE", "500"))
+
+
+class ImportRowError(Exception):
+    pass
+
+
+def read_account_rows(file: BinaryIO, ndjson: bool) -> Iterator[tuple[int, dict]]:
+    # Rows are read lazily so a large upload is never held in memory at once
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    if ndjson:
+        for row_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                row = ImportRowError(f"Invalid JSON: {e.msg}")
+            yield row_number, row
+    else:
+        # Row numbers count the header line as row 1
+        for row_number, row in enumerate(csv.DictReader(text), start=2):
+            yield row_number, row
+
+
+async def read_account_rows_async(
+    file: BinaryIO, ndjson: bool, batch_size: int = IMPORT_CHUNK_SIZE
+) -> AsyncIterator[tuple[int, dict]]:
+    # Reading the upload blocks, so rows are read on the thread pool a batch
+    # at a time instead of on the event loop
+    rows = read_account_rows(file, ndjson)
+    while batch := await run_in_threadpool(list, islice(rows, batch_size)):
+        for row in batch:
+            yield row
+
+
+def _text_field(row: dict, field: str) -> str:
+    # NDJSON rows can hold any JSON type, CSV rows only strings
+    value = row.get(field)
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise ImportRowError(f"Field {field!r} must be a string")
+    return value
+
+
+def validate_account_row(row) -> dict:
+    if isinstance(row, ImportRowError):
+        raise row
+    if not isinstance(row, dict):
+        raise ImportRowError("Row must be an object")
+    username = _text_field(row, "username").strip()
+    password = _text_field(row, "password")
+    role_name = _text_field(row, "role")
+    full_name = _text_field(row, "full_name")
+    if not username:
+        raise ImportRowError("Missing username")
+    if len(username) > 50:
+        raise ImportRowError("Username is longer than 50 characters")
+    if not password:
+        raise ImportRowError("Missing password")
+    try:
+        role = Role((role_name or Role.WORKER.value).lower())
+    except ValueError:
+        raise ImportRowError(f"Unknown role {role_name!r}")
+    return {
+        "username": username,
+        "password": password,
+        "full_name": full_name or None,
+        "role": role,
+    }
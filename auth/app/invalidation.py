@@ -0,0 +1,46 @@
+from contextlib import suppress
+from typing import Optional
+from aiokafka import AIOKafkaConsumer
+from app.cache import TTLCache
+import asyncio
+import logging
+
+
+class AccountCacheInvalidator:
+    """Drops cached accounts as their change events come back from
+    account-stream, so a change made by one worker process reaches the caches
+    of all the others. The cache TTL still bounds staleness if Kafka lags."""
+
+    def __init__(
+        self,
+        consumer: AIOKafkaConsumer,
+        account_cache: TTLCache,
+        retry_seconds: float = 1,
+    ):
+        self.consumer = consumer
+        self.account_cache = account_cache
+        self.retry_seconds = retry_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+
+    async def run(self):
+        while True:
+            try:
+                batches = await self.consumer.getmany(timeout_ms=1000)
+            except Exception:
+                logging.exception("Failed to read account-stream, retrying")
+                await asyncio.sleep(self.retry_seconds)
+                continue
+            for records in batches.values():
+                for record in records:
+                    # Events are keyed by the account's public id
+                    if record.key:
+                        self.account_cache.invalidate(record.key.decode("utf-8"))
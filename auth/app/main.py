@@ -1,74 +1,156 @@
+from contextlib import asynccontextmanager
 from typing import Annotated
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import (
+    APIRouter,
+    FastAPI,
+    Depends,
+    Form,
+    HTTPException,
+    Request,
+    UploadFile,
+)
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from app.services import AuthService
-from app.security import create_access_token, hash_password, decode_access_token
-from app.models import Account
-from app.repository import UserRepository
+from app.security import (
+    create_access_token,
+    decode_access_token,
+    PasswordHasher,
+    PasswordHasherBusy,
+)
+from app.models import Account, Role
+from app.importer import read_account_rows_async
+from app.repository import RefreshTokenRepository, UserRepository
+from app.cache import TTLCache
+from app.outbox import ACCOUNT_STREAM_TOPIC, OutboxRelay
+from app.invalidation import AccountCacheInvalidator
+from app.events import encode_event
+from app.uow import unit_of_work
+from app.health import router as health_router
+from app.throttle import LoginThrottled, create_login_throttle
 import jwt
 import app.database as db
-from aiokafka import AIOKafkaProducer
+from app.engine import pool_stats, warm_pool
+from app.metrics import MetricsMiddleware, metrics_response
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
+import math
 import os
-import uuid
-import json
 
-# Create the FastAPI app
-app = FastAPI()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+async def request_unit_of_work():
+    async with unit_of_work(db.AsyncSession):
+        yield
 
-user_repo = UserRepository(db.AsyncSession)
-auth_service = AuthService(user_repo)
 
-producer = AIOKafkaProducer(
-    bootstrap_servers=os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
-    value_serializer=lambda v: json.dumps(v, default=str).encode("utf-8"),
-)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Everything that binds to the event loop or opens connections is built
+    # here, once per worker process, instead of at import
+    await db.create_tables()
+    await warm_pool(db.engine)
 
+    password_hasher = PasswordHasher()
+    password_hasher.start()
+    account_cache = TTLCache(
+        max_size=int(os.environ.get("ACCOUNT_CACHE_MAX_SIZE", "100000")),
+        ttl=float(os.environ.get("ACCOUNT_CACHE_TTL_SECONDS", "60")),
+    )
+    app.state.auth_service = AuthService(
+        UserRepository(db.AsyncSession),
+        RefreshTokenRepository(db.AsyncSession),
+        password_hasher,
+        account_cache,
+        negative_ttl=float(os.environ.get("ACCOUNT_CACHE_NEGATIVE_TTL_SECONDS", "5")),
+    )
+
+    login_throttle = create_login_throttle()
+    app.state.login_throttle = login_throttle
 
-@app.on_event("startup")
-async def startup():
+    producer = AIOKafkaProducer(
+        bootstrap_servers=os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
+        value_serializer=encode_event,
+    )
     await producer.start()
+    outbox_relay = OutboxRelay(db.AsyncSession, producer)
+    await outbox_relay.start()
+
+    # No group, every worker process reads every partition from the end
+    invalidation_consumer = AIOKafkaConsumer(
+        ACCOUNT_STREAM_TOPIC,
+        bootstrap_servers=os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
+        group_id=None,
+        enable_auto_commit=False,
+        auto_offset_reset="latest",
+    )
+    await invalidation_consumer.start()
+    cache_invalidator = AccountCacheInvalidator(invalidation_consumer, account_cache)
+    await cache_invalidator.start()
 
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        await cache_invalidator.stop()
+        await invalidation_consumer.stop()
+        await outbox_relay.stop()
+        await producer.stop()
+        password_hasher.stop()
+        await login_throttle.close()
 
-@app.on_event("shutdown")
-async def shutdown():
-    await producer.stop()
 
+async def password_hasher_busy(request: Request, exc: PasswordHasherBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Too many concurrent logins, try again later"},
+        headers={"Retry-After": "1"},
+    )
 
-topic = "account-stream"
 
+async def login_throttled(request: Request, exc: LoginThrottled):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Too many login attempts, try again later"},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
 
-def create_account_stream_event(event_type: str, account: Account):
-    return {
-        "event_type": event_type,
-        "event_id": uuid.uuid4(),
-        "payload": {
-            "account_id": account.public_id,
-            "username": account.username,
-            "role": account.role,
-        },
-    }
 
+def get_auth_service(request: Request) -> AuthService:
+    return request.app.state.auth_service
+
+
+AuthServiceDep = Annotated[AuthService, Depends(get_auth_service)]
+
+router = APIRouter()
 
-@app.post("/signup")
-async def signup(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+
+@router.post("/signup")
+async def signup(
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    auth_service: AuthServiceDep,
+):
     existing_account = await auth_service.get_account_by_username(form_data.username)
     if existing_account:
         raise HTTPException(status_code=400, detail="Username already registered")
 
-    hashed_password = hash_password(form_data.password)
+    hashed_password = await auth_service.hash_password(form_data.password)
     account = Account(username=form_data.username, encrypted_password=hashed_password)
     account = await auth_service.create_account(account)
-
-    await producer.send_and_wait(
-        topic, value=create_account_stream_event("account_created", account)
-    )
     return {"account_id": account.public_id, "status": "Account created"}
 
 
-@app.post("/token")
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+@router.post("/token")
+async def login(
+    request: Request,
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    auth_service: AuthServiceDep,
+):
+    # Rejected before the account lookup and bcrypt
+    await request.app.state.login_throttle.check(
+        form_data.username, request.client.host if request.client else None
+    )
     account = await auth_service.authenticate_account(
         form_data.username, form_data.password
     )
@@ -82,16 +164,49 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
     access_token = create_access_token(
         data={"sub": account.public_id, "role": account.role}
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    refresh_token = await auth_service.issue_refresh_token(account)
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+    }
 
 
-@app.get("/verify")
-async def get_account(token: Annotated[str, Depends(oauth2_scheme)]):
+@router.post("/token/refresh")
+async def refresh(refresh_token: Annotated[str, Form()], auth_service: AuthServiceDep):
+    rotated = await auth_service.rotate_refresh_token(refresh_token)
+    if not rotated:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    account, new_refresh_token = rotated
+    access_token = create_access_token(
+        data={"sub": account.public_id, "role": account.role}
+    )
+    return {
+        "access_token": access_token,
+        "refresh_token": new_refresh_token,
+        "token_type": "bearer",
+    }
+
+
+@router.post("/token/revoke")
+async def revoke(refresh_token: Annotated[str, Form()], auth_service: AuthServiceDep):
+    await auth_service.revoke_refresh_token(refresh_token)
+    return {"status": "Token revoked"}
+
+
+@router.get("/verify")
+async def get_account(
+    token: Annotated[str, Depends(oauth2_scheme)], auth_service: AuthServiceDep
+):
     try:
         payload = decode_access_token(token)
         public_id = payload.get("sub")
         role = payload.get("role")
-        account = await auth_service.get_account_by_public_id(public_id)
+        account = await auth_service.get_verified_account(public_id)
         if account:
             return {
                 "account_id": account.public_id,
@@ -107,17 +222,17 @@ async def get_account(token: Annotated[str, Depends(oauth2_scheme)]):
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-@app.delete("/account")
-async def delete_account(token: Annotated[str, Depends(oauth2_scheme)]):
+@router.delete("/account")
+async def delete_account(
+    token: Annotated[str, Depends(oauth2_scheme)], auth_service: AuthServiceDep
+):
     try:
         payload = decode_access_token(token)
         public_id = payload.get("sub")
         account = await auth_service.get_account_by_public_id(public_id)
         if account:
-            deleted = await auth_service.delete_account(account)
-            producer.send_and_wait(
-                topic, value=create_account_stream_event("account_deleted", deleted)
-            )
+            await auth_service.revoke_account_refresh_tokens(account)
+            await auth_service.delete_account(account)
             return {"status": "Account deleted"}
         else:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -127,21 +242,22 @@ async def delete_account(token: Annotated[str, Depends(oauth2_scheme)]):
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-@app.put("/account")
+@router.put("/account")
 async def update_account(
     token: Annotated[str, Depends(oauth2_scheme)],
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    auth_service: AuthServiceDep,
 ):
     try:
         payload = decode_access_token(token)
         public_id = payload.get("sub")
         account = await auth_service.get_account_by_public_id(public_id)
         if account:
-            account.encrypted_password = hash_password(form_data.password)
-            updated = await auth_service.update_account(account)
-            producer.send_and_wait(
-                topic, value=create_account_stream_event("account_updated", updated)
+            account.encrypted_password = await auth_service.hash_password(
+                form_data.password
             )
+            await auth_service.update_account(account)
+            await auth_service.revoke_account_refresh_tokens(account)
             return {"status": "Account updated"}
         else:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -151,17 +267,70 @@ async def update_account(
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-@app.post("/verify")
-async def verify(token: Annotated[str, Depends(oauth2_scheme)]):
+@router.post("/accounts/import")
+async def import_accounts(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    file: UploadFile,
+    auth_service: AuthServiceDep,
+):
+    try:
+        payload = decode_access_token(token)
+    except jwt.exceptions.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token has expired")
+    except jwt.exceptions.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("role") != Role.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admins can import accounts")
+    ndjson = file.content_type in (
+        "application/x-ndjson",
+        "application/jsonl",
+    ) or (
+        file.filename or ""
+    ).endswith((".ndjson", ".jsonl"))
+    report = await auth_service.import_accounts(
+        read_account_rows_async(file.file, ndjson)
+    )
+    return {
+        "created": len(report["created"]),
+        "failed": len(report["failed"]),
+        "accounts": report["created"],
+        "failures": report["failed"],
+    }
+
+
+@router.post("/verify")
+async def verify(
+    token: Annotated[str, Depends(oauth2_scheme)], auth_service: AuthServiceDep
+):
     try:
         payload = decode_access_token(token)
         public_id = payload.get("sub")
-        account = await auth_service.get_account_by_public_id(public_id)
+        account = await auth_service.get_verified_account(public_id)
         if account:
             return {"status": "Token is valid"}
         else:
             raise HTTPException(status_code=401, detail="Invalid token")
-    except jwt.exceptins.ExpiredSignatureError:
+    except jwt.exceptions.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.exceptions.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+
+
+@router.get("/db/pool")
+async def get_pool_stats():
+    return pool_stats(db.engine)
+
+
+@router.get("/metrics")
+async def metrics():
+    return metrics_response(db.engine)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan, dependencies=[Depends(request_unit_of_work)])
+    app.add_middleware(MetricsMiddleware)
+    app.add_exception_handler(PasswordHasherBusy, password_hasher_busy)
+    app.add_exception_handler(LoginThrottled, login_throttled)
+    app.include_router(health_router)
+    app.include_router(router)
+    return app
@@ -1,6 +1,17 @@
 from enum import Enum
 from app.database import Base
-from sqlalchemy import Column, Integer, String, Boolean, Enum as EnumColumn
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Boolean,
+    DateTime,
+    Index,
+    JSON,
+    Enum as EnumColumn,
+    text,
+)
+import datetime
 import uuid
 
 
@@ -14,9 +25,42 @@ class Account(Base):
     __tablename__ = "accounts"
 
     id = Column(Integer, primary_key=True, index=True)
-    public_id = Column(String(50), unique=True, index=True, default=uuid.uuid4)
+    public_id = Column(
+        String(50), unique=True, index=True, default=lambda: str(uuid.uuid4())
+    )
     username = Column(String(50), unique=True, index=True)
     encrypted_password = Column(String(100))
     full_name = Column(String(100))
     is_active = Column(Boolean, default=True)
     role = Column(EnumColumn(Role), default=Role.WORKER)
+
+
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+    __table_args__ = (
+        Index(
+            "ix_outbox_events_unsent",
+            "id",
+            postgresql_where=text("sent_at IS NULL"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String(50), unique=True)
+    topic = Column(String(100))
+    key = Column(String(50), nullable=True)
+    payload = Column(JSON)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    token_hash = Column(String(64), unique=True, index=True)
+    family_id = Column(String(50), index=True)
+    account_id = Column(Integer, index=True)
+    expires_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    revoked_at = Column(DateTime, nullable=True)
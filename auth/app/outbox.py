@@ -0,0 +1,195 @@
+from contextlib import suppress
+from functools import partial
+from time import perf_counter
+from typing import Optional
+from aiokafka import AIOKafkaProducer
+from sqlalchemy import delete, event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+from sqlalchemy.orm import Session
+from app.database import OUTBOX_RELAY_LOCK
+from app.models import Account, OutboxEvent
+from app.metrics import KAFKA_PRODUCE_FAILURES, KAFKA_PRODUCE_SECONDS, db_operation
+from datetime import datetime, timedelta
+import asyncio
+import logging
+import os
+import uuid
+
+ACCOUNT_STREAM_TOPIC = "account-stream"
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "1"))
+# Sent events are kept this long for debugging and replays, then deleted
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION_SECONDS", str(24 * 3600)))
+OUTBOX_PRUNE_INTERVAL = float(os.getenv("OUTBOX_PRUNE_INTERVAL_SECONDS", "60"))
+
+
+def create_account_stream_event(event_type: str, account: Account) -> OutboxEvent:
+    event_id = str(uuid.uuid4())
+    return OutboxEvent(
+        event_id=event_id,
+        topic=ACCOUNT_STREAM_TOPIC,
+        # Keyed so every change of an account lands on the same partition
+        key=str(account.public_id),
+        payload={
+            "event_type": event_type,
+            "event_id": event_id,
+            "payload": {
+                "account_id": str(account.public_id),
+                "username": account.username,
+                "role": account.role,
+            },
+        },
+    )
+
+
+def add_account_event(session: AsyncSession, event_type: str, account: Account):
+    session.add(create_account_stream_event(event_type, account))
+    session.info["outbox_pending"] = True
+
+
+def add_account_deletion(session: AsyncSession, account: Account):
+    add_account_event(session, "account_deleted", account)
+    # The tombstone that follows lets compaction drop every event of the
+    # account, consumers read it as a deletion too
+    session.add(
+        OutboxEvent(
+            event_id=str(uuid.uuid4()),
+            topic=ACCOUNT_STREAM_TOPIC,
+            key=str(account.public_id),
+            payload=None,
+        )
+    )
+
+
+class OutboxRelay:
+    def __init__(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        producer: AIOKafkaProducer,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+        retention: float = OUTBOX_RETENTION,
+        prune_interval: float = OUTBOX_PRUNE_INTERVAL,
+    ):
+        self.async_session = async_session
+        self.producer = producer
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        event.listen(Session, "after_commit", self._after_commit)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        event.remove(Session, "after_commit", self._after_commit)
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _after_commit(self, session: Session):
+        if session.info.pop("outbox_pending", False):
+            self.notify()
+
+    async def run(self):
+        db_operation.set("OutboxRelay.relay_batch")
+        loop = asyncio.get_running_loop()
+        next_prune = loop.time()
+        while True:
+            try:
+                relayed = await self.relay_batch()
+            except Exception:
+                logging.exception("Failed to relay outbox events")
+                relayed = 0
+            if loop.time() >= next_prune:
+                try:
+                    await self.prune()
+                except Exception:
+                    logging.exception("Failed to prune sent outbox events")
+                next_prune = loop.time() + self.prune_interval
+            if relayed < self.batch_size:
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                self._wakeup.clear()
+
+    def _on_delivery(self, topic: str, started: float, delivery: asyncio.Future):
+        if delivery.cancelled() or delivery.exception() is not None:
+            KAFKA_PRODUCE_FAILURES.labels(topic).inc()
+        else:
+            KAFKA_PRODUCE_SECONDS.labels(topic).observe(perf_counter() - started)
+
+    async def lock_relay(self, session: AsyncSession) -> bool:
+        # Every worker runs a relay. Only the one holding this lock sends,
+        # because parallel batches would reorder the events of one account
+        if session.bind.dialect.name != "postgresql":
+            return True
+        return await session.scalar(
+            text("SELECT pg_try_advisory_xact_lock(:lock)"),
+            {"lock": OUTBOX_RELAY_LOCK},
+        )
+
+    async def relay_batch(self) -> int:
+        async with self.async_session() as session:
+            if not await self.lock_relay(session):
+                return 0
+            result = await session.execute(
+                select(OutboxEvent)
+                .where(OutboxEvent.sent_at.is_(None))
+                .order_by(OutboxEvent.id)
+                .limit(self.batch_size)
+                .with_for_update()
+            )
+            events = result.scalars().all()
+            if not events:
+                return 0
+            started = perf_counter()
+            deliveries = []
+            for outbox_event in events:
+                delivery = await self.producer.send(
+                    outbox_event.topic,
+                    value=outbox_event.payload,
+                    key=outbox_event.key.encode("utf-8") if outbox_event.key else None,
+                )
+                delivery.add_done_callback(
+                    partial(self._on_delivery, outbox_event.topic, started)
+                )
+                deliveries.append(delivery)
+            await asyncio.gather(*deliveries)
+            sent_at = datetime.utcnow()
+            for outbox_event in events:
+                outbox_event.sent_at = sent_at
+            await session.commit()
+            return len(events)
+
+    async def prune(self) -> int:
+        sent_before = datetime.utcnow() - timedelta(seconds=self.retention)
+        pruned = 0
+        while True:
+            async with self.async_session() as session:
+                if not await self.lock_relay(session):
+                    return pruned
+                expired = (
+                    select(OutboxEvent.id)
+                    .where(OutboxEvent.sent_at < sent_before)
+                    .order_by(OutboxEvent.id)
+                    .limit(self.batch_size)
+                    .scalar_subquery()
+                )
+                result = await session.execute(
+                    delete(OutboxEvent)
+                    .where(OutboxEvent.id.in_(expired))
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+            pruned += result.rowcount
+            if result.rowcount < self.batch_size:
+                return pruned
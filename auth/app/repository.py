@@ -1,52 +1,140 @@
 from typing import Optional
-from app.models import Account
-from sqlalchemy.ext.asyncio import async_sessionmaker
-from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import Account, RefreshToken
+from app.outbox import add_account_deletion, add_account_event
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.future import select
+from app.uow import Repository
+from app.metrics import instrument_repository
+import datetime
 
 
-class UserRepository:
-    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
-        self.async_session = async_session
-
+@instrument_repository
+class UserRepository(Repository):
     async def get_account_by_username(self, username: str) -> Optional[Account]:
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(select(Account).filter_by(username=username))
             return result.scalar()
 
+    async def get_account_by_id(self, id: int) -> Optional[Account]:
+        async with self.session() as session:
+            result = await session.execute(select(Account).filter_by(id=id))
+            return result.scalar()
+
     async def get_account_by_public_id(self, public_id: str) -> Optional[Account]:
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(
                 select(Account).filter_by(public_id=public_id)
             )
             return result.scalar()
 
     async def create_account(self, account: Account) -> Account:
-        async with self.async_session() as session:
+        async with self.session() as session:
             session.add(account)
-            await session.commit()
+            await session.flush()
+            add_account_event(session, "account_created", account)
+            await self.commit(session)
             await session.refresh(account)
             return account
 
+    async def import_accounts(self, rows: list[dict]) -> list[Account]:
+        async with self.session() as session:
+            result = await session.execute(
+                insert(Account)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=[Account.username])
+                .returning(
+                    Account.id, Account.public_id, Account.username, Account.role
+                )
+            )
+            accounts = [
+                Account(id=id, public_id=public_id, username=username, role=role)
+                for id, public_id, username, role in result
+            ]
+            for account in accounts:
+                add_account_event(session, "account_created", account)
+            await self.commit(session)
+            return accounts
+
     async def delete_account_by_public_id(self, public_id: str) -> Account:
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(
                 select(Account).filter_by(public_id=public_id)
             )
             account = result.scalar()
+            add_account_deletion(session, account)
             await session.delete(account)
-            await session.commit()
+            await self.commit(session)
             return account
 
     async def delete_account(self, account: Account) -> Account:
-        async with self.async_session() as session:
+        async with self.session() as session:
+            add_account_deletion(session, account)
             await session.delete(account)
-            await session.commit()
+            await self.commit(session)
             return account
 
     async def update_account(self, account: Account) -> Account:
-        async with self.async_session() as session:
+        async with self.session() as session:
             session.add(account)
-            await session.commit()
+            await session.flush()
+            add_account_event(session, "account_updated", account)
+            await self.commit(session)
             await session.refresh(account)
             return account
+
+
+@instrument_repository
+class RefreshTokenRepository(Repository):
+    async def get_refresh_token_by_hash(
+        self, token_hash: str, for_update: bool = False
+    ) -> Optional[RefreshToken]:
+        async with self.session() as session:
+            query = select(RefreshToken).filter_by(token_hash=token_hash)
+            if for_update:
+                query = query.with_for_update()
+            result = await session.execute(query)
+            return result.scalar()
+
+    async def add_refresh_token(self, refresh_token: RefreshToken) -> RefreshToken:
+        async with self.session() as session:
+            session.add(refresh_token)
+            await self.commit(session)
+            return refresh_token
+
+    async def revoke_refresh_token(
+        self, refresh_token: RefreshToken, revoked_at: datetime.datetime
+    ) -> RefreshToken:
+        async with self.session() as session:
+            refresh_token.revoked_at = revoked_at
+            session.add(refresh_token)
+            await self.commit(session)
+            return refresh_token
+
+    async def revoke_refresh_token_family(
+        self, family_id: str, revoked_at: datetime.datetime
+    ):
+        async with self.session() as session:
+            await session.execute(
+                update(RefreshToken)
+                .where(
+                    RefreshToken.family_id == family_id,
+                    RefreshToken.revoked_at.is_(None),
+                )
+                .values(revoked_at=revoked_at)
+            )
+            await self.commit(session)
+
+    async def revoke_account_refresh_tokens(
+        self, account_id: int, revoked_at: datetime.datetime
+    ):
+        async with self.session() as session:
+            await session.execute(
+                update(RefreshToken)
+                .where(
+                    RefreshToken.account_id == account_id,
+                    RefreshToken.revoked_at.is_(None),
+                )
+                .values(revoked_at=revoked_at)
+            )
+            await self.commit(session)
@@ -1,12 +1,32 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import Optional
+from prometheus_client import Histogram
 import jwt
 import bcrypt
 from datetime import datetime, timedelta
+import asyncio
+import hashlib
 import os
+import secrets
 
+BCRYPT_SECONDS = Histogram(
+    "bcrypt_duration_seconds",
+    "Time spent hashing or verifying a password on the worker pool",
+    ["operation"],
+)
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+# Verified against when the username is unknown, so that case costs as much
+# as a wrong password and doesn't reveal which usernames exist
+DUMMY_PASSWORD_HASH = "$2b$12$HPMc6tUw2/6oPjdrYGo1m.Z9OI/3c6Xs94WRUjWmRUgw2rxklrhfe"
+
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", os.cpu_count() or 1))
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", BCRYPT_WORKERS * 8))
 
 
 def hash_password(password: str) -> str:
@@ -19,6 +39,62 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     )
 
 
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(
+        self, workers: int = BCRYPT_WORKERS, max_pending: int = BCRYPT_MAX_PENDING
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._slots = asyncio.Semaphore(self.workers)
+
+    def stop(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        # Bulk work waits for a slot instead of being rejected, and keeps at
+        # most one job per worker queued so logins can still get through
+        in_flight = asyncio.Semaphore(self.workers)
+
+        async def hash_one(password: str) -> str:
+            async with in_flight:
+                return await self._run(hash_password, password, wait=True)
+
+        return await asyncio.gather(*(hash_one(password) for password in passwords))
+
+    async def _run(self, fn, *args, wait: bool = False):
+        if not wait and self.pending >= self.max_pending:
+            raise PasswordHasherBusy()
+        self.pending += 1
+        try:
+            # Only as many jobs as workers reach the pool, the rest wait here
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                started = perf_counter()
+                result = await loop.run_in_executor(self._executor, fn, *args)
+                BCRYPT_SECONDS.labels(fn.__name__).observe(perf_counter() - started)
+                return result
+        finally:
+            self.pending -= 1
+
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -30,6 +106,16 @@ def decode_access_token(token: str) -> dict:
     return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
 
 
+def generate_refresh_token() -> str:
+    return secrets.token_urlsafe(32)
+
+
+def hash_refresh_token(token: str) -> str:
+    # Refresh tokens are random, so a fast digest is enough to keep them
+    # out of the database without paying for bcrypt on every refresh
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
 def get_account_from_token(token: str) -> dict:
     payload = decode_access_token(token)
     if payload:
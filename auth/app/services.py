@@ -1,12 +1,37 @@
-from typing import Optional
-from app.security import verify_password
-from app.models import Account
-from app.repository import UserRepository
+from datetime import datetime, timedelta
+from typing import AsyncIterable, Optional
+from app.account_cache import AccountRecord, NOT_FOUND
+from app.cache import TTLCache
+from app.importer import IMPORT_CHUNK_SIZE, ImportRowError, validate_account_row
+from app.security import (
+    DUMMY_PASSWORD_HASH,
+    REFRESH_TOKEN_EXPIRE_DAYS,
+    PasswordHasher,
+    generate_refresh_token,
+    hash_refresh_token,
+)
+from app.models import Account, RefreshToken
+from app.repository import RefreshTokenRepository, UserRepository
+from app.uow import after_commit
+import logging
+import time
+import uuid
 
 
 class AuthService:
-    def __init__(self, user_repo: UserRepository):
+    def __init__(
+        self,
+        user_repo: UserRepository,
+        refresh_token_repo: RefreshTokenRepository,
+        password_hasher: PasswordHasher,
+        account_cache: TTLCache,
+        negative_ttl: float = 5,
+    ):
         self.user_repo = user_repo
+        self.refresh_token_repo = refresh_token_repo
+        self.password_hasher = password_hasher
+        self.account_cache = account_cache
+        self.negative_ttl = negative_ttl
 
     async def get_account_by_username(self, username: str) -> Optional[Account]:
         return await self.user_repo.get_account_by_username(username)
@@ -14,19 +39,179 @@ class AuthService:
     async def get_account_by_public_id(self, public_id: str) -> Optional[Account]:
         return await self.user_repo.get_account_by_public_id(public_id)
 
+    async def get_verified_account(self, public_id: str) -> Optional[AccountRecord]:
+        cached = self.account_cache.get(public_id)
+        if cached is not None:
+            return None if cached is NOT_FOUND else cached
+        account = await self.user_repo.get_account_by_public_id(public_id)
+        if account is None:
+            self.account_cache.set(
+                public_id, NOT_FOUND, expires_at=time.time() + self.negative_ttl
+            )
+            return None
+        record = AccountRecord(account.public_id, account.username, account.role)
+        self.account_cache.set(public_id, record)
+        return record
+
+    def invalidate_account(self, public_id: str):
+        self.account_cache.invalidate(public_id)
+        # Drop anything cached from the old row while the change was uncommitted
+        after_commit(lambda: self.account_cache.invalidate(public_id))
+
     async def authenticate_account(
         self, username: str, password: str
     ) -> Optional[Account]:
         account = await self.user_repo.get_account_by_username(username)
-        if account and verify_password(password, account.encrypted_password):
+        # Don't hold a pooled connection while bcrypt runs
+        await self.user_repo.release_connection()
+        if not account:
+            await self.password_hasher.verify(password, DUMMY_PASSWORD_HASH)
+            return None
+        if await self.password_hasher.verify(password, account.encrypted_password):
             return account
         return None
 
+    async def hash_password(self, password: str) -> str:
+        await self.user_repo.release_connection()
+        return await self.password_hasher.hash(password)
+
+    async def import_accounts(
+        self, rows: AsyncIterable[tuple[int, dict]], chunk_size: int = IMPORT_CHUNK_SIZE
+    ) -> dict:
+        report = {"created": [], "failed": []}
+        chunk = []
+        seen = set()
+        async for row_number, row in rows:
+            try:
+                account = validate_account_row(row)
+                if account["username"] in seen:
+                    raise ImportRowError("Duplicate username in import")
+            except ImportRowError as e:
+                failure = {"row": row_number, "error": str(e)}
+                if isinstance(row, dict) and isinstance(row.get("username"), str):
+                    failure["username"] = row["username"]
+                report["failed"].append(failure)
+                continue
+            seen.add(account["username"])
+            chunk.append((row_number, account))
+            if len(chunk) >= chunk_size:
+                await self._import_chunk(chunk, report)
+                chunk = []
+        if chunk:
+            await self._import_chunk(chunk, report)
+        report["failed"].sort(key=lambda failure: failure["row"])
+        return report
+
+    async def _import_chunk(self, chunk: list[tuple[int, dict]], report: dict):
+        await self.user_repo.release_connection()
+        hashes = await self.password_hasher.hash_many(
+            [account["password"] for _, account in chunk]
+        )
+        rows = [
+            {
+                "username": account["username"],
+                "encrypted_password": hashed_password,
+                "full_name": account["full_name"],
+                "role": account["role"],
+            }
+            for (_, account), hashed_password in zip(chunk, hashes)
+        ]
+        created = {
+            account.username: account
+            for account in await self.user_repo.import_accounts(rows)
+        }
+        # Each chunk commits on its own so a late failure keeps earlier rows
+        await self.user_repo.release_connection()
+        for row_number, account in chunk:
+            imported = created.get(account["username"])
+            if imported:
+                report["created"].append(
+                    {
+                        "row": row_number,
+                        "username": imported.username,
+                        "account_id": imported.public_id,
+                    }
+                )
+            else:
+                report["failed"].append(
+                    {
+                        "row": row_number,
+                        "username": account["username"],
+                        "error": "Username already registered",
+                    }
+                )
+
     async def create_account(self, account: Account) -> Account:
-        return await self.user_repo.create_account(account)
+        account = await self.user_repo.create_account(account)
+        self.invalidate_account(account.public_id)
+        return account
 
     async def delete_account(self, account: Account) -> Account:
-        return await self.user_repo.delete_account_by_public_id(account.public_id)
+        deleted = await self.user_repo.delete_account_by_public_id(account.public_id)
+        self.invalidate_account(account.public_id)
+        return deleted
 
     async def update_account(self, account: Account) -> Account:
-        return await self.user_repo.update_account(account)
+        updated = await self.user_repo.update_account(account)
+        self.invalidate_account(account.public_id)
+        return updated
+
+    async def issue_refresh_token(
+        self, account: Account, family_id: Optional[str] = None
+    ) -> str:
+        token = generate_refresh_token()
+        await self.refresh_token_repo.add_refresh_token(
+            RefreshToken(
+                token_hash=hash_refresh_token(token),
+                family_id=family_id or str(uuid.uuid4()),
+                account_id=account.id,
+                expires_at=datetime.utcnow()
+                + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+            )
+        )
+        return token
+
+    async def rotate_refresh_token(self, token: str) -> Optional[tuple[Account, str]]:
+        refresh_token = await self.refresh_token_repo.get_refresh_token_by_hash(
+            hash_refresh_token(token), for_update=True
+        )
+        if not refresh_token:
+            return None
+        now = datetime.utcnow()
+        if refresh_token.revoked_at is not None:
+            # A rotated token was presented again, so it has leaked: cut off
+            # every token descended from the same login
+            logging.warning(
+                f"Refresh token reuse for account {refresh_token.account_id}, "
+                f"revoking family {refresh_token.family_id}"
+            )
+            await self.refresh_token_repo.revoke_refresh_token_family(
+                refresh_token.family_id, now
+            )
+            # Commit now, the 401 that follows rolls the request back
+            await self.refresh_token_repo.release_connection()
+            return None
+        if refresh_token.expires_at < now:
+            return None
+        account = await self.user_repo.get_account_by_id(refresh_token.account_id)
+        if not account:
+            return None
+        await self.refresh_token_repo.revoke_refresh_token(refresh_token, now)
+        new_token = await self.issue_refresh_token(account, refresh_token.family_id)
+        return account, new_token
+
+    async def revoke_refresh_token(self, token: str) -> bool:
+        refresh_token = await self.refresh_token_repo.get_refresh_token_by_hash(
+            hash_refresh_token(token)
+        )
+        if not refresh_token:
+            return False
+        await self.refresh_token_repo.revoke_refresh_token_family(
+            refresh_token.family_id, datetime.utcnow()
+        )
+        return True
+
+    async def revoke_account_refresh_tokens(self, account: Account):
+        await self.refresh_token_repo.revoke_account_refresh_tokens(
+            account.id, datetime.utcnow()
+        )
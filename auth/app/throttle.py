@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from typing import Optional
+from prometheus_client import Counter
+import logging
+import os
+import time
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+LOGIN_THROTTLED = Counter(
+    "login_throttled_total", "Login attempts rejected before any bcrypt work", ["scope"]
+)
+
+# Rates are attempts per second, a rate of 0 disables that limit
+LOGIN_THROTTLE_USER_RATE = float(os.getenv("LOGIN_THROTTLE_USER_RATE", str(5 / 60)))
+LOGIN_THROTTLE_USER_BURST = int(os.getenv("LOGIN_THROTTLE_USER_BURST", "5"))
+LOGIN_THROTTLE_IP_RATE = float(os.getenv("LOGIN_THROTTLE_IP_RATE", "1"))
+LOGIN_THROTTLE_IP_BURST = int(os.getenv("LOGIN_THROTTLE_IP_BURST", "30"))
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "100000"))
+THROTTLE_REDIS_URL = os.getenv("THROTTLE_REDIS_URL")
+
+
+class LoginThrottled(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(
+        self, rate: float, burst: int, max_keys: int = LOGIN_THROTTLE_MAX_KEYS
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str) -> float:
+        """Takes one token, returns 0 or the seconds until one is available."""
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        # Evicting the least recently used key only ever forgives a client
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# Same algorithm as TokenBucket, atomically on the Redis side and on its clock
+REDIS_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket:
+    def __init__(self, client, prefix: str, rate: float, burst: int):
+        self.prefix = prefix
+        self.rate = rate
+        self.burst = burst
+        self._script = client.register_script(REDIS_TAKE)
+        # Used while Redis is unreachable, so a Redis outage doesn't open the
+        # door to unlimited bcrypt work
+        self._fallback = TokenBucket(rate, burst)
+
+    async def take(self, key: str) -> float:
+        try:
+            wait = await self._script(
+                keys=[f"{self.prefix}:{key}"], args=[self.rate, self.burst]
+            )
+            return float(wait)
+        except Exception:
+            logging.exception("Redis throttle unavailable, using the local limit")
+            return await self._fallback.take(key)
+
+
+class LoginThrottle:
+    def __init__(self, per_user, per_ip, client=None):
+        self.per_user = per_user
+        self.per_ip = per_ip
+        self.client = client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def check(self, username: str, ip: Optional[str]):
+        if self.per_ip and ip:
+            wait = await self.per_ip.take(ip)
+            if wait:
+                LOGIN_THROTTLED.labels("ip").inc()
+                raise LoginThrottled(wait)
+        if self.per_user:
+            wait = await self.per_user.take(username.lower())
+            if wait:
+                LOGIN_THROTTLED.labels("user").inc()
+                raise LoginThrottled(wait)
+
+
+def create_login_throttle(redis_url: Optional[str] = THROTTLE_REDIS_URL):
+    client = None
+    if redis_url:
+        if redis is None:
+            raise RuntimeError("THROTTLE_REDIS_URL requires the redis package")
+        client = redis.from_url(redis_url)
+
+    def bucket(scope: str, rate: float, burst: int):
+        if rate <= 0:
+            return None
+        if client is not None:
+            return RedisTokenBucket(client, f"login-throttle:{scope}", rate, burst)
+        return TokenBucket(rate, burst)
+
+    return LoginThrottle(
+        bucket("user", LOGIN_THROTTLE_USER_RATE, LOGIN_THROTTLE_USER_BURST),
+        bucket("ip", LOGIN_THROTTLE_IP_RATE, LOGIN_THROTTLE_IP_BURST),
+        client,
+    )
@@ -0,0 +1,159 @@
+# In-memory stand-in for the parts of aiokafka the services use. Topics live in
+# the process that imports this module, so events only flow between producers
+# and consumers of the same service.
+from collections import defaultdict, namedtuple
+import asyncio
+import sys
+import types
+
+TopicPartition = namedtuple("TopicPartition", ["topic", "partition"])
+ConsumerRecord = namedtuple(
+    "ConsumerRecord", ["topic", "partition", "offset", "key", "value", "timestamp"]
+)
+
+topics: dict[str, list] = defaultdict(list)
+# Offsets committed per consumer group, the next consumer of a group resumes there
+group_offsets: dict[tuple, int] = {}
+
+
+class AIOKafkaProducer:
+    def __init__(self, key_serializer=None, value_serializer=None, **config):
+        self.key_serializer = key_serializer
+        self.value_serializer = value_serializer
+        self.config = config
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def send(self, topic, value=None, key=None, **kwargs):
+        if self.key_serializer and key is not None:
+            key = self.key_serializer(key)
+        if self.value_serializer:
+            value = self.value_serializer(value)
+        records = topics[topic]
+        records.append(
+            ConsumerRecord(
+                topic,
+                0,
+                len(records),
+                key,
+                value,
+                int(1000 * asyncio.get_running_loop().time()),
+            )
+        )
+        delivery = asyncio.get_running_loop().create_future()
+        delivery.set_result(None)
+        return delivery
+
+    async def send_and_wait(self, topic, value=None, key=None, **kwargs):
+        return await (await self.send(topic, value=value, key=key, **kwargs))
+
+
+class ConsumerRebalanceListener:
+    async def on_partitions_revoked(self, revoked):
+        pass
+
+    async def on_partitions_assigned(self, assigned):
+        pass
+
+
+class AIOKafkaConsumer:
+    def __init__(self, *subscribed, value_deserializer=None, **config):
+        self.subscribed = list(subscribed)
+        self.value_deserializer = value_deserializer
+        self.config = config
+        self.positions: dict[TopicPartition, int] = {}
+        self.committed_offsets: dict[TopicPartition, int] = {}
+        self.listener = None
+
+    def _resume(self, tp):
+        group = self.config.get("group_id")
+        self.positions.setdefault(tp, group_offsets.get((group, tp), 0))
+
+    async def start(self):
+        for topic in self.subscribed:
+            self._resume(TopicPartition(topic, 0))
+
+    def subscribe(self, topics, listener=None):
+        self.subscribed = list(topics)
+        self.listener = listener
+        for topic in self.subscribed:
+            self._resume(TopicPartition(topic, 0))
+
+    async def topics(self):
+        return set(topics)
+
+    def partitions_for_topic(self, topic):
+        return {0} if topic in topics else None
+
+    def assign(self, partitions):
+        self.positions = {}
+        for tp in partitions:
+            self._resume(tp)
+
+    async def seek_to_beginning(self, *partitions):
+        for tp in partitions or list(self.positions):
+            self.positions[tp] = 0
+
+    async def beginning_offsets(self, partitions):
+        return {tp: 0 for tp in partitions}
+
+    async def end_offsets(self, partitions):
+        return {tp: len(topics[tp.topic]) for tp in partitions}
+
+    async def position(self, tp):
+        return self.positions[tp]
+
+    async def stop(self):
+        pass
+
+    def highwater(self, tp):
+        return len(topics[tp.topic])
+
+    def seek(self, tp, offset):
+        self.positions[tp] = offset
+
+    async def commit(self, offsets=None):
+        self.committed_offsets.update(offsets or self.positions)
+        group = self.config.get("group_id")
+        for tp, offset in (offsets or self.positions).items():
+            group_offsets[(group, tp)] = offset
+
+    async def getmany(self, timeout_ms=0, max_records=None):
+        if self.listener:
+            # The whole subscription is assigned on the first poll
+            listener, self.listener = self.listener, None
+            await listener.on_partitions_assigned(set(self.positions))
+        for tp, position in self.positions.items():
+            records = topics[tp.topic][position : position + (max_records or 500)]
+            if records:
+                self.positions[tp] = position + len(records)
+                if self.value_deserializer:
+                    records = [
+                        record._replace(value=self.value_deserializer(record.value))
+                        for record in records
+                    ]
+                return {tp: records}
+        await asyncio.sleep(timeout_ms / 1000)
+        return {}
+
+
+def install():
+    module = types.ModuleType("aiokafka")
+    module.AIOKafkaProducer = AIOKafkaProducer
+    module.AIOKafkaConsumer = AIOKafkaConsumer
+    module.ConsumerRebalanceListener = ConsumerRebalanceListener
+    module.TopicPartition = TopicPartition
+    module.ConsumerRecord = ConsumerRecord
+    structs = types.ModuleType("aiokafka.structs")
+    structs.TopicPartition = TopicPartition
+    structs.ConsumerRecord = ConsumerRecord
+    module.structs = structs
+    sys.modules["aiokafka"] = module
+    sys.modules["aiokafka.structs"] = structs
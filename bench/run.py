@@ -0,0 +1,377 @@
+from pathlib import Path
+from typing import Awaitable, Callable
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import httpx
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+class Service:
+    def __init__(self, name: str, port: int, env: dict):
+        self.name = name
+        self.url = f"http://127.0.0.1:{port}"
+        self.port = port
+        self.env = env
+        self.process = None
+
+    async def start(self, timeout: float = 30):
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                str(ROOT / "bench" / "serve.py"),
+                str(ROOT / self.name),
+                str(self.port),
+            ],
+            env={**os.environ, **self.env},
+        )
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"{self.name} exited during startup")
+                try:
+                    response = await client.get(f"{self.url}/readyz")
+                    if response.status_code == 200:
+                        return
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"{self.name} did not start in {timeout}s")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        # Latencies of successful requests only, failures are just counted
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def report(self) -> dict:
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {"requests": self.errors, "ok": 0, "errors": self.errors}
+
+        def percentile(p: float) -> float:
+            index = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+            return round(latencies[index] * 1000, 3)
+
+        return {
+            "requests": len(latencies) + self.errors,
+            "ok": len(latencies),
+            "errors": self.errors,
+            "rps": round(len(latencies) / self.elapsed, 2) if self.elapsed else None,
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+            "p50_ms": percentile(50),
+            "p95_ms": percentile(95),
+            "p99_ms": percentile(99),
+        }
+
+
+async def drive(
+    name: str,
+    calls: list[Callable[[], Awaitable[httpx.Response]]],
+    concurrency: int,
+) -> Phase:
+    phase = Phase(name)
+    pending = iter(calls)
+
+    async def worker():
+        for call in pending:
+            started = time.perf_counter()
+            try:
+                ok = response_ok(await call())
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                phase.latencies.append(time.perf_counter() - started)
+            else:
+                phase.errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    phase.elapsed = time.perf_counter() - started
+    print(f"{name:>14}: {json.dumps(phase.report())}")
+    return phase
+
+
+def response_ok(response: httpx.Response) -> bool:
+    if response.status_code >= 400:
+        return False
+    # Some endpoints report errors in a 200 body
+    try:
+        body = response.json()
+    except ValueError:
+        return True
+    return not (isinstance(body, dict) and "detail" in body)
+
+
+async def promote_to_admin(db_url: str, username: str):
+    engine = create_async_engine(db_url)
+    try:
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                text("UPDATE accounts SET role = 'ADMIN' WHERE username = :username"),
+                {"username": username},
+            )
+        if result.rowcount != 1:
+            raise RuntimeError(f"Could not promote {username} to admin")
+    finally:
+        await engine.dispose()
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def run_benchmark(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix="async-arch-bench-"))
+    auth_db_url = args.auth_db_url or f"sqlite+aiosqlite:///{workdir / 'auth.db'}"
+    tasktracker_db_url = (
+        args.tasktracker_db_url or f"sqlite+aiosqlite:///{workdir / 'tasktracker.db'}"
+    )
+    secret = uuid.uuid4().hex
+    common_env = {"SECRET_KEY": secret, "KAFKA_BOOTSTRAP_SERVERS": "in-memory"}
+    auth = Service(
+        "auth",
+        args.auth_port,
+        {
+            **common_env,
+            "DATABASE_URL": auth_db_url,
+            # Every simulated client shares 127.0.0.1
+            "LOGIN_THROTTLE_IP_RATE": "0",
+            # Every concurrent signup or login may wait for a bcrypt worker
+            "BCRYPT_MAX_PENDING": str(args.concurrency),
+        },
+    )
+    tasktracker = Service(
+        "tasktracker",
+        args.tasktracker_port,
+        {
+            **common_env,
+            "DATABASE_URL": tasktracker_db_url,
+            "AUTH_SERVICE_URL": auth.url,
+        },
+    )
+    phases: list[Phase] = []
+    run_id = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=args.concurrency)
+    try:
+        await auth.start()
+        await tasktracker.start()
+        async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+            credentials = [
+                {"username": f"bench-{run_id}-{i}", "password": f"secret-{i}"}
+                for i in range(args.requests)
+            ]
+            admin = {"username": f"bench-{run_id}-admin", "password": "secret"}
+
+            async def signup(form):
+                return await client.post(f"{auth.url}/signup", data=form)
+
+            phases.append(
+                await drive(
+                    "signup",
+                    [lambda form=form: signup(form) for form in credentials],
+                    args.concurrency,
+                )
+            )
+            await signup(admin)
+            await promote_to_admin(auth_db_url, admin["username"])
+
+            tokens: list[str] = []
+
+            async def login(form):
+                response = await client.post(f"{auth.url}/token", data=form)
+                if response.status_code == 200:
+                    tokens.append(response.json()["access_token"])
+                return response
+
+            phases.append(
+                await drive(
+                    "token",
+                    [lambda form=form: login(form) for form in credentials],
+                    args.concurrency,
+                )
+            )
+            if not tokens:
+                raise RuntimeError("No login succeeded, see the token phase errors")
+            admin_response = await client.post(f"{auth.url}/token", data=admin)
+            admin_token = admin_response.json().get("access_token")
+            if admin_token is None:
+                raise RuntimeError(f"Admin login failed: {admin_response.text}")
+
+            phases.append(
+                await drive(
+                    "verify",
+                    [
+                        lambda token=token: client.get(
+                            f"{auth.url}/verify", headers=bearer(token)
+                        )
+                        for token in tokens
+                    ],
+                    args.concurrency,
+                )
+            )
+
+            # Tasktracker learns about accounts on their first request
+            for token in tokens + [admin_token]:
+                await client.get(f"{tasktracker.url}/tasks", headers=bearer(token))
+
+            task = {"title": "bench", "description": "benchmark task"}
+            phases.append(
+                await drive(
+                    "create_task",
+                    [
+                        lambda token=tokens[i % len(tokens)]: client.post(
+                            f"{tasktracker.url}/create_task",
+                            json=task,
+                            headers=bearer(token),
+                        )
+                        for i in range(args.requests)
+                    ],
+                    args.concurrency,
+                )
+            )
+
+            if tasktracker_db_url.startswith("sqlite"):
+                print("       shuffle: skipped, set-based shuffle needs Postgres")
+            else:
+                phases.append(
+                    await drive(
+                        "shuffle",
+                        [
+                            lambda: client.put(
+                                f"{tasktracker.url}/shuffle",
+                                headers=bearer(admin_token),
+                            )
+                            for _ in range(args.shuffles)
+                        ],
+                        1,
+                    )
+                )
+
+            assigned = []
+            for token in tokens:
+                response = await client.get(
+                    f"{tasktracker.url}/tasks",
+                    params={"status": "assigned", "limit": 500},
+                    headers=bearer(token),
+                )
+                assigned += [
+                    (token, task["id"]) for task in response.json().get("tasks", [])
+                ]
+            phases.append(
+                await drive(
+                    "complete_task",
+                    [
+                        lambda token=token, id=id: client.put(
+                            f"{tasktracker.url}/complete_task",
+                            params={"id": id},
+                            headers=bearer(token),
+                        )
+                        for token, id in assigned
+                    ],
+                    args.concurrency,
+                )
+            )
+    finally:
+        tasktracker.stop()
+        auth.stop()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "shuffles": args.shuffles,
+            "auth_db": auth_db_url.split(":", 1)[0],
+            "tasktracker_db": tasktracker_db_url.split(":", 1)[0],
+        },
+        "results": {phase.name: phase.report() for phase in phases},
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline_path: str, candidate_path: str):
+    baseline = json.loads(Path(baseline_path).read_text())
+    candidate = json.loads(Path(candidate_path).read_text())
+    print(
+        f"{'phase':>14} {'metric':>8} {baseline['commit']:>12} {candidate['commit']:>12}"
+    )
+    for phase, results in candidate["results"].items():
+        before = baseline["results"].get(phase, {})
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms", "errors"):
+            old, new = before.get(metric), results.get(metric)
+            change = ""
+            if old and new is not None:
+                change = f"{(new - old) / old * 100:+.1f}%"
+            print(f"{phase:>14} {metric:>8} {str(old):>12} {str(new):>12} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark auth and tasktracker")
+    subcommands = parser.add_subparsers(dest="command")
+    run = subcommands.add_parser("run", help="run the benchmark")
+    run.add_argument("--requests", type=int, default=200)
+    run.add_argument("--concurrency", type=int, default=20)
+    run.add_argument("--shuffles", type=int, default=3)
+    run.add_argument("--auth-db-url", help="defaults to a temporary SQLite file")
+    run.add_argument("--tasktracker-db-url", help="defaults to a temporary SQLite file")
+    run.add_argument("--auth-port", type=int, default=13000)
+    run.add_argument("--tasktracker-port", type=int, default=14000)
+    run.add_argument("--output", help="defaults to bench/results/<time>-<commit>.json")
+    diff = subcommands.add_parser("compare", help="compare two result files")
+    diff.add_argument("baseline")
+    diff.add_argument("candidate")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.baseline, args.candidate)
+        return
+
+    if args.command is None:
+        args = parser.parse_args(["run"])
+    try:
+        report = asyncio.run(run_benchmark(args))
+    except RuntimeError as e:
+        sys.exit(f"Benchmark aborted: {e}")
+    output = Path(
+        args.output
+        or RESULTS_DIR
+        / f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{report['commit']}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
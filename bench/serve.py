@@ -0,0 +1,23 @@
+# Run one service under uvicorn with the in-memory Kafka fake:
+#   python bench/serve.py <service-dir> <port>
+
+from pathlib import Path
+import asyncio
+import sys
+import uvicorn
+
+sys.path.insert(0, str(Path(__file__).parent))
+import fake_kafka  # noqa: E402
+
+if __name__ == "__main__":
+    service_dir, port = sys.argv[1], int(sys.argv[2])
+    sys.path.insert(0, service_dir)
+    fake_kafka.install()
+    config = uvicorn.Config(
+        "app.main:create_app",
+        factory=True,
+        host="127.0.0.1",
+        port=port,
+        log_level="warning",
+    )
+    asyncio.run(uvicorn.Server(config).serve())
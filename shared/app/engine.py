@@ -0,0 +1,97 @@
+from contextlib import AsyncExitStack
+from typing import Optional
+from sqlalchemy import MetaData, event, inspect
+from sqlalchemy.engine import Connection, make_url
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+import os
+
+
+def env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes", "on")
+
+
+def engine_options(db_url: str) -> dict:
+    url = make_url(db_url)
+    options = {}
+    if url.get_backend_name() != "sqlite":
+        options.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+            pool_pre_ping=env_flag("DB_POOL_PRE_PING", "true"),
+        )
+    if url.get_driver_name() == "psycopg":
+        # psycopg prepares a statement once it has run this many times,
+        # "none" disables server-side prepared statements (e.g. behind pgbouncer)
+        prepare_threshold = os.getenv("DB_PREPARE_THRESHOLD", "5")
+        options["connect_args"] = {
+            "prepare_threshold": (
+                None if prepare_threshold.lower() == "none" else int(prepare_threshold)
+            )
+        }
+    return options
+
+
+def create_engine(db_url: str) -> AsyncEngine:
+    engine = create_async_engine(db_url, **engine_options(db_url))
+    prepared_max = os.getenv("DB_PREPARED_MAX")
+    if prepared_max and make_url(db_url).get_driver_name() == "psycopg":
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_prepared_max(dbapi_connection, connection_record):
+            dbapi_connection.driver_connection.prepared_max = int(prepared_max)
+
+    return engine
+
+
+async def warm_pool(engine: AsyncEngine, connections: Optional[int] = None):
+    # Connect up front so the first requests after a start don't pay for it
+    pool = engine.pool
+    if not hasattr(pool, "size"):
+        return
+    if connections is None:
+        connections = int(os.getenv("DB_POOL_WARM", str(pool.size())))
+    async with AsyncExitStack() as stack:
+        for _ in range(min(connections, pool.size())):
+            await stack.enter_async_context(engine.connect())
+
+
+def pool_stats(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    if not hasattr(pool, "checkedout"):
+        return {"pool": type(pool).__name__}
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    checked_out = pool.checkedout()
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": checked_out,
+        "overflow": pool.overflow(),
+        "capacity": capacity,
+        "saturation": checked_out / capacity if capacity else 0.0,
+    }
+
+
+def upgrade_schema(conn: Connection, metadata: MetaData) -> set[tuple[str, str]]:
+    """Adds columns and indexes that were added to existing tables, which
+    create_all leaves alone. Returns the (table, column) pairs it added."""
+    inspector = inspect(conn)
+    added = set()
+    for table in metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            )
+            added.add((table.name, column.name))
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                conn.execute(CreateIndex(index))
+    return added
@@ -0,0 +1,223 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Optional, Union
+import json
+import logging
+import os
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# magic byte, codec id, schema version, event type length
+HEADER = struct.Struct(">BBHB")
+MAGIC = 0xE7
+
+SCHEMAS_DIR = Path(__file__).parent / "event_schemas"
+
+
+class Codec(ABC):
+    id: int
+    name: str
+
+    @abstractmethod
+    def encode(self, value: dict) -> bytes: ...
+
+    @abstractmethod
+    def decode(self, data: bytes) -> dict: ...
+
+
+class JsonCodec(Codec):
+    id = 0
+    name = "json"
+
+    def encode(self, value: dict) -> bytes:
+        return json.dumps(value, separators=(",", ":"), default=str).encode("utf-8")
+
+    def decode(self, data: bytes) -> dict:
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    id = 1
+    name = "orjson"
+
+    def encode(self, value: dict) -> bytes:
+        return orjson.dumps(value, default=str)
+
+    def decode(self, data: bytes) -> dict:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    id = 2
+    name = "msgpack"
+
+    def encode(self, value: dict) -> bytes:
+        return msgpack.packb(value, default=str)
+
+    def decode(self, data: bytes) -> dict:
+        return msgpack.unpackb(data)
+
+
+CODECS = {codec.id: codec for codec in (JsonCodec(), OrjsonCodec(), MsgpackCodec())}
+CODEC_MODULES = {"orjson": orjson, "msgpack": msgpack}
+
+
+def get_codec(name: str) -> Codec:
+    for codec in CODECS.values():
+        if codec.name == name:
+            if name in CODEC_MODULES and CODEC_MODULES[name] is None:
+                raise RuntimeError(f"Event codec {name} requires the {name} package")
+            return codec
+    raise ValueError(f"Unknown event codec {name}")
+
+
+class UndecodableEvent(NamedTuple):
+    """Stands in for a record value that could not be decoded, e.g. a newer
+    schema version or a codec that is not installed. Consumers dead-letter it
+    instead of committing past it."""
+
+    data: bytes
+    reason: str
+
+
+class SchemaRegistry:
+    def __init__(self, path: Path = SCHEMAS_DIR):
+        # event_type -> version -> schema
+        self.schemas: dict[str, dict[int, dict]] = {}
+        self.upcasters: dict[tuple[str, int], Callable[[dict], dict]] = {}
+        for schema_file in sorted(path.glob("*.json")):
+            topic = json.loads(schema_file.read_text())
+            for event_type, versions in topic["events"].items():
+                self.schemas[event_type] = {
+                    int(version): schema for version, schema in versions.items()
+                }
+
+    def latest_version(self, event_type: str) -> int:
+        return max(self.schemas[event_type])
+
+    def upcaster(self, event_type: str, from_version: int):
+        def register(fn: Callable[[dict], dict]):
+            self.upcasters[(event_type, from_version)] = fn
+            return fn
+
+        return register
+
+    def is_supported(self, event_type: str, version: int) -> bool:
+        versions = self.schemas.get(event_type)
+        if not versions or version not in versions:
+            return False
+        # Older versions are only accepted when they can be upgraded
+        return all(
+            (event_type, older) in self.upcasters
+            for older in range(version, max(versions))
+        )
+
+    def validate(self, event_type: str, version: int, payload: dict):
+        missing = [
+            field
+            for field in self.schemas[event_type][version]["required"]
+            if field not in payload
+        ]
+        if missing:
+            raise ValueError(f"{event_type} v{version} is missing {missing}")
+
+    def upgrade(self, event_type: str, version: int, payload: dict) -> dict:
+        for older in range(version, self.latest_version(event_type)):
+            payload = self.upcasters[(event_type, older)](payload)
+        return payload
+
+
+class EventSerializer:
+    def __init__(self, registry: SchemaRegistry, codec: Codec):
+        self.registry = registry
+        self.codec = codec
+
+    def serialize(self, event: dict) -> bytes:
+        event_type = event["event_type"]
+        version = event.get("event_version") or self.registry.latest_version(event_type)
+        self.registry.validate(event_type, version, event["payload"])
+        name = event_type.encode("ascii")
+        body = self.codec.encode({"id": event["event_id"], "p": event["payload"]})
+        return HEADER.pack(MAGIC, self.codec.id, version, len(name)) + name + body
+
+    def deserialize(
+        self, data: Optional[bytes]
+    ) -> Union[dict[str, Any], UndecodableEvent, None]:
+        # Tombstones in a compacted topic carry no value
+        if data is None:
+            return None
+        # Raising here would break the Kafka client's record iterator, so a
+        # record that cannot be decoded is handed on for dead-lettering
+        try:
+            if not data or data[0] != MAGIC:
+                return self.deserialize_legacy(data)
+            return self.deserialize_framed(data)
+        except Exception as e:
+            logging.warning("Undecodable event", exc_info=True)
+            return UndecodableEvent(data, repr(e))
+
+    def deserialize_framed(self, data: bytes) -> dict[str, Any]:
+        _, codec_id, version, name_length = HEADER.unpack_from(data)
+        name_end = HEADER.size + name_length
+        event_type = data[HEADER.size : name_end].decode("ascii")
+        # Unknown types and versions are rejected before the body is decoded
+        if not self.registry.is_supported(event_type, version):
+            raise ValueError(f"Unsupported event {event_type} v{version}")
+        codec = CODECS.get(codec_id)
+        if codec is None or CODEC_MODULES.get(codec.name, json) is None:
+            raise ValueError(f"{event_type} uses unavailable codec {codec_id}")
+        body = codec.decode(data[name_end:])
+        if not isinstance(body, dict):
+            raise ValueError("Event body is not an object")
+        return self.to_event(event_type, version, body["id"], body["p"])
+
+    def deserialize_legacy(self, data: bytes) -> dict[str, Any]:
+        event = json.loads(data)
+        if not isinstance(event, dict):
+            raise ValueError("Event is not an object")
+        if not self.registry.is_supported(event["event_type"], 1):
+            raise ValueError(f"Unsupported event {event['event_type']}")
+        return self.to_event(
+            event["event_type"], 1, event["event_id"], event["payload"]
+        )
+
+    def to_event(
+        self, event_type: str, version: int, event_id: str, payload: dict
+    ) -> dict[str, Any]:
+        if not isinstance(payload, dict):
+            raise ValueError(f"{event_type} payload is not an object")
+        self.registry.validate(event_type, version, payload)
+        latest = self.registry.latest_version(event_type)
+        return {
+            "event_type": event_type,
+            "event_version": latest,
+            "event_id": event_id,
+            "payload": self.registry.upgrade(event_type, version, payload),
+        }
+
+
+registry = SchemaRegistry()
+serializer = EventSerializer(registry, get_codec(os.getenv("EVENT_CODEC", "json")))
+
+
+def encode_event(event: Optional[dict]) -> Optional[bytes]:
+    # A tombstone is sent without a value
+    if event is None:
+        return None
+    return serializer.serialize(event)
+
+
+def decode_event(
+    data: Optional[bytes],
+) -> Union[dict[str, Any], UndecodableEvent, None]:
+    return serializer.deserialize(data)
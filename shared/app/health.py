@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Request, Response
+import app.database as db
+import logging
+
+router = APIRouter()
+
+
+@router.get("/healthz")
+async def healthz():
+    # Liveness only says the worker is serving requests
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+async def readyz(request: Request, response: Response):
+    if not getattr(request.app.state, "ready", False):
+        response.status_code = 503
+        return {"status": "not ready"}
+    try:
+        await db.check_connection()
+    except Exception:
+        logging.exception("Readiness check failed")
+        response.status_code = 503
+        return {"status": "database unavailable"}
+    return {"status": "ok"}
@@ -0,0 +1,143 @@
+from contextvars import ContextVar
+from functools import wraps
+from inspect import isasyncgenfunction, iscoroutinefunction
+from time import perf_counter
+from fastapi import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from app.engine import pool_stats
+import os
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "SQL statement latency by repository method",
+    ["operation"],
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30),
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Pooled connections by state", ["state"]
+)
+KAFKA_PRODUCE_SECONDS = Histogram(
+    "kafka_produce_duration_seconds",
+    "Time from enqueueing an event to its broker acknowledgement",
+    ["topic"],
+)
+KAFKA_PRODUCE_FAILURES = Counter(
+    "kafka_produce_failures_total", "Events that could not be delivered", ["topic"]
+)
+KAFKA_CONSUMER_LAG = Gauge(
+    "kafka_consumer_lag",
+    "Messages between the consumer position and the high watermark",
+    ["topic", "partition"],
+)
+
+db_operation: ContextVar[str] = ContextVar("db_operation", default="unknown")
+
+
+def instrument_repository(cls):
+    # Tag every SQL statement issued by a repository method with its name
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_"):
+            continue
+        operation = f"{cls.__name__}.{name}"
+        if iscoroutinefunction(method):
+            setattr(cls, name, _tag_coroutine(method, operation))
+        elif isasyncgenfunction(method):
+            setattr(cls, name, _tag_async_generator(method, operation))
+    return cls
+
+
+def _tag_coroutine(method, operation: str):
+    @wraps(method)
+    async def tagged(*args, **kwargs):
+        token = db_operation.set(operation)
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            db_operation.reset(token)
+
+    return tagged
+
+
+def _tag_async_generator(method, operation: str):
+    @wraps(method)
+    async def tagged(*args, **kwargs):
+        token = db_operation.set(operation)
+        try:
+            async for item in method(*args, **kwargs):
+                yield item
+        finally:
+            db_operation.reset(token)
+
+    return tagged
+
+
+def instrument_engine(engine: AsyncEngine):
+    # The start time lives on the statement's execution context, so a statement
+    # that fails between the two events leaves nothing behind on the connection
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        context.query_started = perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        started = context.query_started
+        DB_QUERY_SECONDS.labels(db_operation.get()).observe(perf_counter() - started)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], route.path if route else "unmatched", str(status)
+            ).observe(perf_counter() - started)
+
+
+def metrics_response(engine: AsyncEngine) -> Response:
+    stats = pool_stats(engine)
+    for state in ("checked_in", "checked_out", "overflow"):
+        if state in stats:
+            DB_POOL_CONNECTIONS.labels(state).set(stats[state])
+    registry = None
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(
+        generate_latest(registry) if registry else generate_latest(),
+        media_type=CONTENT_TYPE_LATEST,
+    )
@@ -0,0 +1,117 @@
+from functools import partial
+from time import perf_counter
+from typing import Any, Optional
+from aiokafka import AIOKafkaProducer
+from app.events import UndecodableEvent, encode_event
+from app.metrics import KAFKA_PRODUCE_FAILURES, KAFKA_PRODUCE_SECONDS
+import asyncio
+import logging
+import os
+
+KAFKA_LINGER_MS = int(os.getenv("KAFKA_LINGER_MS", "20"))
+KAFKA_MAX_BATCH_SIZE = int(os.getenv("KAFKA_MAX_BATCH_SIZE", str(256 * 1024)))
+KAFKA_COMPRESSION_TYPE = os.getenv("KAFKA_COMPRESSION_TYPE", "gzip") or None
+
+DEAD_LETTER_SUFFIX = "-dead-letter"
+
+
+def serialize_key(key: Any) -> Optional[bytes]:
+    if key is None or isinstance(key, bytes):
+        return key
+    return str(key).encode("utf-8")
+
+
+def serialize_value(value: Any) -> bytes:
+    # Dead-lettered records are forwarded as the bytes they arrived with
+    if isinstance(value, bytes):
+        return value
+    return encode_event(value)
+
+
+class EventPublisher:
+    def __init__(
+        self,
+        bootstrap_servers: str,
+        linger_ms: int = KAFKA_LINGER_MS,
+        max_batch_size: int = KAFKA_MAX_BATCH_SIZE,
+        compression_type: Optional[str] = KAFKA_COMPRESSION_TYPE,
+    ):
+        self.producer = AIOKafkaProducer(
+            bootstrap_servers=bootstrap_servers,
+            linger_ms=linger_ms,
+            max_batch_size=max_batch_size,
+            compression_type=compression_type,
+            key_serializer=serialize_key,
+            value_serializer=serialize_value,
+        )
+        self.sent = 0
+        self.failed = 0
+        self._pending: set[asyncio.Future] = set()
+        self._scheduled: set[asyncio.Task] = set()
+
+    async def start(self):
+        await self.producer.start()
+
+    async def stop(self):
+        await self.flush()
+        await self.producer.stop()
+
+    async def publish(self, topic: str, value: dict, key: Any = None):
+        # send() only waits when the accumulator is full, delivery is tracked
+        # in the background
+        started = perf_counter()
+        try:
+            delivery = await self.producer.send(topic, value=value, key=key)
+        except Exception:
+            self.failed += 1
+            KAFKA_PRODUCE_FAILURES.labels(topic).inc()
+            logging.exception(f"Failed to enqueue event for {topic}")
+            return
+        self._pending.add(delivery)
+        delivery.add_done_callback(partial(self._on_delivery, topic, started))
+
+    def publish_later(self, events: list[tuple[str, dict, Any]]):
+        """Publishes (topic, value, key) events in order from a background
+        task, for callers that cannot await, like after-commit callbacks."""
+
+        async def publish_all():
+            for topic, value, key in events:
+                await self.publish(topic, value, key=key)
+
+        task = asyncio.get_running_loop().create_task(publish_all())
+        self._scheduled.add(task)
+        task.add_done_callback(self._scheduled.discard)
+
+    async def dead_letter(
+        self, topic: str, key: Optional[bytes], event: UndecodableEvent
+    ):
+        """Forwards a record that could not be decoded to <topic>-dead-letter
+        and waits for the broker to acknowledge it, so the caller only commits
+        past the record once it is kept somewhere."""
+        await self.producer.send_and_wait(
+            topic + DEAD_LETTER_SUFFIX,
+            value=event.data,
+            key=key,
+            headers=[("reason", event.reason.encode("utf-8"))],
+        )
+        logging.warning(f"Dead-lettered undecodable {topic} event: {event.reason}")
+
+    def _on_delivery(self, topic: str, started: float, delivery: asyncio.Future):
+        self._pending.discard(delivery)
+        if delivery.cancelled() or delivery.exception() is not None:
+            self.failed += 1
+            KAFKA_PRODUCE_FAILURES.labels(topic).inc()
+            logging.error(f"Failed to deliver event to {topic}: {delivery!r}")
+        else:
+            self.sent += 1
+            KAFKA_PRODUCE_SECONDS.labels(topic).observe(perf_counter() - started)
+
+    async def flush(self):
+        if self._scheduled:
+            await asyncio.gather(*self._scheduled, return_exceptions=True)
+        await self.producer.flush()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "failed": self.failed, "pending": len(self._pending)}
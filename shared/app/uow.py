@@ -0,0 +1,97 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Optional
+from time import perf_counter
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from app.metrics import DB_POOL_WAIT_SECONDS
+
+_current_session: ContextVar[Optional[AsyncSession]] = ContextVar(
+    "current_session", default=None
+)
+
+
+@asynccontextmanager
+async def unit_of_work(
+    async_session: async_sessionmaker[AsyncSession],
+) -> AsyncIterator[AsyncSession]:
+    current = _current_session.get()
+    if current is not None:
+        yield current
+        return
+    async with async_session() as session:
+        token = _current_session.set(session)
+        try:
+            yield session
+            await session.commit()
+            run_after_commit(session)
+        except BaseException:
+            run_after_rollback(session)
+            await session.rollback()
+            raise
+        finally:
+            _current_session.reset(token)
+
+
+def after_commit(callback: Callable[[], None]):
+    # Deferred until the surrounding unit of work commits, if there is one
+    current = _current_session.get()
+    if current is None:
+        callback()
+    else:
+        current.info.setdefault("after_commit", []).append(callback)
+
+
+def after_rollback(callback: Callable[[], None]):
+    # Undoes in-memory changes if the surrounding unit of work fails to commit,
+    # outside of one the caller sees the error itself
+    current = _current_session.get()
+    if current is not None:
+        current.info.setdefault("after_rollback", []).append(callback)
+
+
+def run_after_commit(session: AsyncSession):
+    session.info.pop("after_rollback", None)
+    for callback in session.info.pop("after_commit", []):
+        callback()
+
+
+def run_after_rollback(session: AsyncSession):
+    session.info.pop("after_commit", None)
+    for callback in session.info.pop("after_rollback", []):
+        callback()
+
+
+class Repository:
+    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
+        self.async_session = async_session
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[AsyncSession]:
+        current = _current_session.get()
+        if current is not None:
+            await self.checkout(current)
+            yield current
+            return
+        async with self.async_session() as session:
+            await self.checkout(session)
+            yield session
+
+    async def checkout(self, session: AsyncSession):
+        if session.in_transaction():
+            return
+        started = perf_counter()
+        await session.connection()
+        DB_POOL_WAIT_SECONDS.observe(perf_counter() - started)
+
+    async def commit(self, session: AsyncSession):
+        # Inside a unit of work the changes are committed once, at its end
+        if session is _current_session.get():
+            await session.flush()
+        else:
+            await session.commit()
+
+    async def release_connection(self):
+        current = _current_session.get()
+        if current is not None:
+            await current.commit()
+            run_after_commit(current)
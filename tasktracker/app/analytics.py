@@ -0,0 +1,80 @@
+from datetime import date, datetime
+from typing import Iterable, Optional
+
+COUNTERS = ("open", "completed", "assigned_today")
+
+
+class TaskAnalytics:
+    """Per-worker task counters kept up to date as tasks change, so reading
+    them never scans the tasks table. "assigned_today" counts the tasks a
+    worker currently holds that were assigned to them today (UTC)."""
+
+    def __init__(self):
+        self._counts: dict[int, dict[str, int]] = {}
+        self.day: date = datetime.utcnow().date()
+        # Changes made while a rebuild reads the counts, replayed on top
+        self._journal: Optional[list[tuple[int, str, int]]] = None
+
+    def begin_rebuild(self):
+        self._journal = []
+
+    def abort_rebuild(self):
+        self._journal = None
+
+    def replace(self, rows: Iterable[tuple[int, int, int, int]], day: date):
+        journal, self._journal = self._journal or [], None
+        self.day = day
+        self._counts = {
+            worker_id: dict(zip(COUNTERS, counts)) for worker_id, *counts in rows
+        }
+        for worker_id, counter, delta in journal:
+            self._add(worker_id, counter, delta)
+
+    def _roll_over(self):
+        today = datetime.utcnow().date()
+        if today != self.day:
+            self.day = today
+            for counts in self._counts.values():
+                counts["assigned_today"] = 0
+            if self._journal is not None:
+                self._journal = [
+                    entry for entry in self._journal if entry[1] != "assigned_today"
+                ]
+
+    def _add(self, worker_id: int, counter: str, delta: int):
+        counts = self._counts.setdefault(worker_id, dict.fromkeys(COUNTERS, 0))
+        counts[counter] += delta
+        if self._journal is not None:
+            self._journal.append((worker_id, counter, delta))
+
+    def task_assigned(self, worker_id: int, assigned_at: datetime):
+        self._roll_over()
+        self._add(worker_id, "open", 1)
+        if assigned_at.date() == self.day:
+            self._add(worker_id, "assigned_today", 1)
+
+    def task_reassigned(
+        self,
+        previous_id: Optional[int],
+        previous_assigned_at: Optional[datetime],
+        worker_id: int,
+        assigned_at: datetime,
+    ):
+        self._roll_over()
+        if previous_id is not None:
+            self._add(previous_id, "open", -1)
+            if previous_assigned_at and previous_assigned_at.date() == self.day:
+                self._add(previous_id, "assigned_today", -1)
+        self.task_assigned(worker_id, assigned_at)
+
+    def task_completed(self, worker_id: int):
+        self._add(worker_id, "open", -1)
+        self._add(worker_id, "completed", 1)
+
+    def for_worker(self, worker_id: int) -> dict[str, int]:
+        self._roll_over()
+        return dict(self._counts.get(worker_id) or dict.fromkeys(COUNTERS, 0))
+
+    def all(self) -> dict[int, dict[str, int]]:
+        self._roll_over()
+        return {worker_id: dict(counts) for worker_id, counts in self._counts.items()}
@@ -0,0 +1,144 @@
+from abc import ABC, abstractmethod
+from typing import Optional
+from app.roster import WorkerRoster
+import heapq
+import os
+
+ASSIGNMENT_STRATEGY = os.getenv("ASSIGNMENT_STRATEGY", "random")
+
+
+class AssignmentStrategy(ABC):
+    """Picks the worker a new task is assigned to.
+
+    The hooks below are no-ops, a strategy overrides the ones it needs to keep
+    its own view of the workers' loads."""
+
+    # Whether a shuffle deals open tasks out in turn instead of at random
+    balanced_shuffle = False
+
+    def __init__(self, roster: WorkerRoster):
+        self.roster = roster
+
+    @abstractmethod
+    def pick(self) -> Optional[int]: ...
+
+    def begin_rebuild(self):
+        pass
+
+    def abort_rebuild(self):
+        pass
+
+    def replace(self, open_counts: dict[int, int]):
+        pass
+
+    def task_assigned(self, worker_id: int):
+        pass
+
+    def task_unassigned(self, worker_id: int):
+        pass
+
+
+class RandomAssignment(AssignmentStrategy):
+    """Assigns every task to a random worker from the roster."""
+
+    def pick(self) -> Optional[int]:
+        return self.roster.pick()
+
+
+class LeastLoadedAssignment(AssignmentStrategy):
+    """Assigns every task to the worker with the fewest open tasks.
+
+    Loads live in a min-heap of (open tasks, worker id). A changed load is
+    pushed as a new entry and the outdated one is skipped once it reaches the
+    top, so picking and updating are O(log n). A picked worker is charged
+    right away, so concurrent creates spread out before they commit. Changes
+    made while a rebuild queries the database are journaled and replayed
+    onto its result."""
+
+    balanced_shuffle = True
+
+    def __init__(self, roster: WorkerRoster):
+        super().__init__(roster)
+        self._loads: dict[int, int] = {}
+        self._heap: list[tuple[int, int]] = []
+        self._roster_version = roster.version
+        self._journal: Optional[list[tuple[int, int]]] = None
+
+    def begin_rebuild(self):
+        self._journal = []
+
+    def abort_rebuild(self):
+        self._journal = None
+
+    def _charge(self, worker_id: int, delta: int):
+        if self._journal is not None:
+            self._journal.append((worker_id, delta))
+        self._push(worker_id, max(0, self._loads[worker_id] + delta))
+
+    def _push(self, worker_id: int, load: int):
+        self._loads[worker_id] = load
+        heapq.heappush(self._heap, (load, worker_id))
+        if len(self._heap) > 2 * len(self._loads) + 64:
+            # Too many outdated entries, rebuild from the current loads
+            self._heap = [(load, worker_id) for worker_id, load in self._loads.items()]
+            heapq.heapify(self._heap)
+
+    def _sync_roster(self):
+        if self._roster_version == self.roster.version:
+            return
+        self._roster_version = self.roster.version
+        workers = set(self.roster.ids())
+        # Entries of removed workers are skipped when they reach the top
+        for worker_id in self._loads.keys() - workers:
+            del self._loads[worker_id]
+        for worker_id in workers - self._loads.keys():
+            self._push(worker_id, 0)
+
+    def pick(self) -> Optional[int]:
+        self._sync_roster()
+        while self._heap:
+            load, worker_id = self._heap[0]
+            if self._loads.get(worker_id) == load:
+                self._loads[worker_id] = load + 1
+                heapq.heapreplace(self._heap, (load + 1, worker_id))
+                if self._journal is not None:
+                    self._journal.append((worker_id, 1))
+                return worker_id
+            heapq.heappop(self._heap)
+        return None
+
+    def replace(self, open_counts: dict[int, int]):
+        journal, self._journal = self._journal or [], None
+        self._roster_version = self.roster.version
+        self._loads = {
+            worker_id: open_counts.get(worker_id, 0) for worker_id in self.roster.ids()
+        }
+        for worker_id, delta in journal:
+            if worker_id in self._loads:
+                self._loads[worker_id] = max(0, self._loads[worker_id] + delta)
+        self._heap = [(load, worker_id) for worker_id, load in self._loads.items()]
+        heapq.heapify(self._heap)
+
+    def task_assigned(self, worker_id: int):
+        self._sync_roster()
+        if worker_id in self._loads:
+            self._charge(worker_id, 1)
+
+    def task_unassigned(self, worker_id: int):
+        self._sync_roster()
+        if worker_id in self._loads:
+            self._charge(worker_id, -1)
+
+
+STRATEGIES = {"random": RandomAssignment, "least_loaded": LeastLoadedAssignment}
+
+
+def create_assignment_strategy(
+    roster: WorkerRoster, name: str = ASSIGNMENT_STRATEGY
+) -> AssignmentStrategy:
+    strategy = STRATEGIES.get(name)
+    if strategy is None:
+        raise RuntimeError(
+            f"Unknown ASSIGNMENT_STRATEGY {name!r}, expected one of {sorted(STRATEGIES)}"
+        )
+    return strategy(roster)
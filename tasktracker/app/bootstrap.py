@@ -0,0 +1,123 @@
+from typing import Optional
+from aiokafka import AIOKafkaConsumer
+from aiokafka.structs import ConsumerRecord, TopicPartition
+from app.events import UndecodableEvent, decode_event
+from app.repository import AccountRepository
+from app.services import AccountService
+from time import perf_counter
+import logging
+import os
+
+ACCOUNT_STREAM_TOPIC = "account-stream"
+
+# "auto" bootstraps when no snapshot offsets are recorded (a new replica or
+# a wiped database), "always" on every start, "never" disables it
+ACCOUNT_BOOTSTRAP = os.getenv("ACCOUNT_BOOTSTRAP", "auto")
+ACCOUNT_BOOTSTRAP_BATCH_SIZE = int(os.getenv("ACCOUNT_BOOTSTRAP_BATCH_SIZE", "5000"))
+
+
+class AccountBootstrap:
+    """Loads the latest state of every account from account-stream in bulk
+    before the regular consumer starts, and hands it the offsets to resume
+    from."""
+
+    def __init__(
+        self,
+        account_service: AccountService,
+        account_repo: AccountRepository,
+        bootstrap_servers: str,
+        group_id: str,
+        topic: str = ACCOUNT_STREAM_TOPIC,
+        batch_size: int = ACCOUNT_BOOTSTRAP_BATCH_SIZE,
+    ):
+        self.account_service = account_service
+        self.account_repo = account_repo
+        self.bootstrap_servers = bootstrap_servers
+        self.group_id = group_id
+        self.topic = topic
+        self.batch_size = batch_size
+
+    async def needed(self, mode: str = ACCOUNT_BOOTSTRAP) -> bool:
+        if mode == "never":
+            return False
+        if mode == "always":
+            return True
+        return not await self.account_repo.get_consumer_offsets(self.topic)
+
+    async def run(self) -> int:
+        started = perf_counter()
+        # Joins no group, partitions are assigned by hand, but offsets are
+        # committed under the regular consumer's group id
+        consumer = AIOKafkaConsumer(
+            bootstrap_servers=self.bootstrap_servers,
+            group_id=self.group_id,
+            enable_auto_commit=False,
+        )
+        await consumer.start()
+        try:
+            await consumer.topics()
+            partitions = consumer.partitions_for_topic(self.topic) or set()
+            tps = [TopicPartition(self.topic, p) for p in sorted(partitions)]
+            if not tps:
+                logging.info(f"No {self.topic} partitions yet, nothing to bootstrap")
+                return 0
+            consumer.assign(tps)
+            await consumer.seek_to_beginning(*tps)
+            beginning = await consumer.beginning_offsets(tps)
+            end = await consumer.end_offsets(tps)
+            latest = await self.read_latest(consumer, beginning, end)
+            await self.load(latest)
+            offsets = {tp.partition: end[tp] for tp in tps}
+            await self.account_repo.save_consumer_offsets(self.topic, offsets)
+            await consumer.commit({tp: end[tp] for tp in tps})
+        finally:
+            await consumer.stop()
+        logging.info(
+            f"Bootstrapped {len(latest)} accounts from {self.topic} up to "
+            f"{offsets} in {perf_counter() - started:.2f}s"
+        )
+        return len(latest)
+
+    async def read_latest(
+        self,
+        consumer: AIOKafkaConsumer,
+        beginning: dict[TopicPartition, int],
+        end: dict[TopicPartition, int],
+    ) -> dict[str, Optional[dict]]:
+        latest: dict[str, Optional[dict]] = {}
+        remaining = {tp for tp in end if end[tp] > beginning[tp]}
+        while remaining:
+            batches = await consumer.getmany(
+                timeout_ms=1000, max_records=self.batch_size
+            )
+            for tp, records in batches.items():
+                for record in records:
+                    if record.offset < end[tp]:
+                        self.collect(latest, record)
+                if await consumer.position(tp) >= end[tp]:
+                    remaining.discard(tp)
+        return latest
+
+    def collect(self, latest: dict[str, Optional[dict]], record: ConsumerRecord):
+        key = record.key.decode("utf-8") if record.key else None
+        if record.value is None:
+            # A tombstone, compaction keeps only these for deleted accounts
+            if key:
+                latest[key] = None
+            return
+        event = decode_event(record.value)
+        if isinstance(event, UndecodableEvent):
+            # Loading without it would lose the account's latest state
+            raise RuntimeError(
+                f"Cannot bootstrap from undecodable {record.topic} event at "
+                f"offset {record.offset}: {event.reason}"
+            )
+        # Later events replace earlier ones, like compaction would
+        latest[key or event["payload"]["account_id"]] = event
+
+    async def load(self, latest: dict[str, Optional[dict]]):
+        states = list(latest.items())
+        for start in range(0, len(states), self.batch_size):
+            await self.account_service.apply_latest_account_states(
+                dict(states[start : start + self.batch_size]), []
+            )
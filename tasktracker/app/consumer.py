@@ -0,0 +1,208 @@
+from collections import deque
+from contextlib import suppress
+from typing import Awaitable, Callable, Optional
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
+from aiokafka.structs import ConsumerRecord, TopicPartition
+from app.events import UndecodableEvent
+from app.metrics import KAFKA_CONSUMER_LAG
+import asyncio
+import logging
+import os
+import zlib
+
+CONSUMER_WORKERS = int(os.getenv("ACCOUNT_CONSUMER_WORKERS", "4"))
+CONSUMER_BATCH_SIZE = int(os.getenv("ACCOUNT_CONSUMER_BATCH_SIZE", "500"))
+CONSUMER_TIMEOUT_MS = int(os.getenv("ACCOUNT_CONSUMER_TIMEOUT_MS", "1000"))
+CONSUMER_RETRY_SECONDS = float(os.getenv("ACCOUNT_CONSUMER_RETRY_SECONDS", "1"))
+CONSUMER_DRAIN_SECONDS = float(os.getenv("ACCOUNT_CONSUMER_DRAIN_SECONDS", "30"))
+
+
+class OffsetTracker:
+    """Tracks in-flight offsets of one partition so only a contiguous prefix of
+    completed records is ever committed."""
+
+    def __init__(self):
+        self._in_flight: deque[int] = deque()
+        self._done: set[int] = set()
+        self.committable: Optional[int] = None
+
+    def add(self, offset: int):
+        self._in_flight.append(offset)
+
+    def done(self, offset: int):
+        self._done.add(offset)
+        while self._in_flight and self._in_flight[0] in self._done:
+            completed = self._in_flight.popleft()
+            self._done.discard(completed)
+            self.committable = completed + 1
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._in_flight)
+
+
+class PartitionedConsumer:
+    def __init__(
+        self,
+        consumer: AIOKafkaConsumer,
+        handler: Callable[[list[dict]], Awaitable[None]],
+        dead_letter: Callable[
+            [str, Optional[bytes], UndecodableEvent], Awaitable[None]
+        ],
+        workers: int = CONSUMER_WORKERS,
+        batch_size: int = CONSUMER_BATCH_SIZE,
+        timeout_ms: int = CONSUMER_TIMEOUT_MS,
+        retry_seconds: float = CONSUMER_RETRY_SECONDS,
+        drain_seconds: float = CONSUMER_DRAIN_SECONDS,
+    ):
+        self.consumer = consumer
+        self.handler = handler
+        self.dead_letter = dead_letter
+        self.workers = workers
+        self.batch_size = batch_size
+        self.timeout_ms = timeout_ms
+        self.retry_seconds = retry_seconds
+        self.drain_seconds = drain_seconds
+        # Bounded so a slow worker holds back fetching instead of buffering
+        self._queues = [asyncio.Queue(maxsize=batch_size) for _ in range(workers)]
+        self._offsets: dict[TopicPartition, OffsetTracker] = {}
+        self._committed: dict[TopicPartition, int] = {}
+        self._tasks: list[asyncio.Task] = []
+        # Set whenever a worker finishes a batch
+        self._progress = asyncio.Event()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self.work(queue)) for queue in self._queues]
+        self._tasks.append(asyncio.create_task(self.fetch()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        with suppress(Exception):
+            await self.commit()
+
+    def worker_for(self, key: Optional[bytes], event: dict) -> int:
+        if key is None:
+            key = str(event["payload"].get("account_id")).encode("utf-8")
+        return zlib.crc32(key) % self.workers
+
+    async def fetch(self):
+        while True:
+            try:
+                await self.fetch_once()
+            except Exception:
+                # A failed poll or commit (e.g. during a rebalance) must not
+                # stop consumption, uncommitted records are fetched again
+                logging.exception("Failed to fetch account events, retrying")
+                await asyncio.sleep(self.retry_seconds)
+
+    async def fetch_once(self):
+        batches = await self.consumer.getmany(
+            timeout_ms=self.timeout_ms, max_records=self.batch_size
+        )
+        for tp, records in batches.items():
+            highwater = self.consumer.highwater(tp)
+            if highwater is not None:
+                KAFKA_CONSUMER_LAG.labels(tp.topic, tp.partition).set(
+                    highwater - records[-1].offset - 1
+                )
+            offsets = self._offsets.setdefault(tp, OffsetTracker())
+            for record in records:
+                offsets.add(record.offset)
+                if record.value is None:
+                    offsets.done(record.offset)
+                    continue
+                if isinstance(record.value, UndecodableEvent):
+                    await self.dead_letter_record(tp, record)
+                    offsets.done(record.offset)
+                    continue
+                # Every event of one account goes to the same worker, so
+                # per-account order is kept while accounts run in parallel
+                queue = self._queues[self.worker_for(record.key, record.value)]
+                # The tracker travels with the record, so a record finishing
+                # after its partition was revoked never marks a newer one
+                await queue.put((offsets, record.offset, record.value))
+        await self.commit()
+
+    async def dead_letter_record(self, tp: TopicPartition, record: ConsumerRecord):
+        while True:
+            try:
+                await self.dead_letter(tp.topic, record.key, record.value)
+                return
+            except Exception:
+                # The partition waits, an undecodable event is never committed
+                # past before it is kept in the dead-letter topic
+                logging.exception("Failed to dead-letter account event, retrying")
+                await asyncio.sleep(self.retry_seconds)
+
+    async def work(self, queue: asyncio.Queue):
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            events = [event for _, _, event in batch]
+            while True:
+                try:
+                    await self.handler(events)
+                    break
+                except Exception:
+                    # Later events of these accounts wait behind the retry
+                    logging.exception("Failed to apply account events, retrying")
+                    await asyncio.sleep(self.retry_seconds)
+            for offsets, offset, _ in batch:
+                offsets.done(offset)
+            self._progress.set()
+            logging.info(f"Applied {len(events)} account events")
+
+    async def drain(self, partitions: list[TopicPartition]):
+        trackers = [self._offsets[tp] for tp in partitions if tp in self._offsets]
+        while True:
+            self._progress.clear()
+            if not any(tracker.pending for tracker in trackers):
+                return
+            await self._progress.wait()
+
+    async def release(self, partitions: list[TopicPartition]):
+        """Finishes and commits what was fetched from partitions that are
+        being revoked, then forgets them."""
+        try:
+            await asyncio.wait_for(self.drain(partitions), self.drain_seconds)
+        except asyncio.TimeoutError:
+            logging.warning(
+                f"Revoked partitions still busy after {self.drain_seconds}s, "
+                "their unfinished events will be consumed again"
+            )
+        try:
+            await self.commit(partitions)
+        except Exception:
+            logging.exception("Failed to commit revoked partitions")
+        for tp in partitions:
+            self._offsets.pop(tp, None)
+            self._committed.pop(tp, None)
+
+    async def commit(self, partitions: Optional[list[TopicPartition]] = None):
+        offsets = {
+            tp: tracker.committable
+            for tp, tracker in self._offsets.items()
+            if tracker.committable is not None
+            and tracker.committable != self._committed.get(tp)
+            and (partitions is None or tp in partitions)
+        }
+        if offsets:
+            await self.consumer.commit(offsets)
+            self._committed.update(offsets)
+
+
+class PartitionRebalanceListener(ConsumerRebalanceListener):
+    def __init__(self, partitioned: PartitionedConsumer):
+        self.partitioned = partitioned
+
+    async def on_partitions_revoked(self, revoked):
+        # Commit only while the partitions are still ours
+        await self.partitioned.release(list(revoked))
+
+    async def on_partitions_assigned(self, assigned):
+        pass
@@ -1,15 +1,31 @@
-from fastapi import FastAPI, Depends, HTTPException
+from contextlib import asynccontextmanager, suppress
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 import app.database as db
+from app.engine import pool_stats, warm_pool
+from app.metrics import MetricsMiddleware, metrics_response
 from app.repository import (
     AuthIdentityRepository,
     AccountRepository,
     TaskRepository,
 )
-from typing import Annotated
-from app.models import Account, Task
+from typing import Annotated, Any, Awaitable, Callable, Optional
+from app.models import Account, Task, Status
 from app.services import TaskService, AuthService, AccountService
-from aiokafka import AIOKafkaProducer, AIOKafkaConsumer
+from app.cache import TTLCache
+from app.roster import WorkerRoster
+from app.analytics import TaskAnalytics
+from app.assignment import create_assignment_strategy
+from app.sweeper import IdentitySweeper
+from app.uow import after_commit, unit_of_work
+from app.publisher import EventPublisher
+from app.events import decode_event
+from app.consumer import PartitionedConsumer, PartitionRebalanceListener
+from app.bootstrap import AccountBootstrap
+from app.health import router as health_router
+from aiokafka import AIOKafkaConsumer
+import httpx
 import json
 import os
 import asyncio
@@ -17,50 +33,161 @@ import uuid
 from pydantic import BaseModel
 import logging
 
+task_stream_topic = "task-stream"
+tasks_topic = "tasks"
 
-app = FastAPI()
-tokenUrl = os.environ.get("AUTH_SERVICE_URL") + "/token"
+roster_refresh_seconds = float(os.environ.get("ROSTER_REFRESH_SECONDS", "30"))
+# Off by default, the rebuild counts every task. POST /analytics/rebuild runs
+# one on demand
+analytics_refresh_seconds = float(os.environ.get("ANALYTICS_REFRESH_SECONDS", "0"))
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl=tokenUrl)
 
-authIdentityRepo = AuthIdentityRepository(db.AsyncSession)
-accountRepo = AccountRepository(db.AsyncSession)
-taskRepo = TaskRepository(db.AsyncSession)
+async def request_unit_of_work():
+    async with unit_of_work(db.AsyncSession):
+        yield
 
-tasksService = TaskService(taskRepo, accountRepo)
-authService = AuthService(accountRepo, authIdentityRepo)
-accountService = AccountService(accountRepo)
 
-task_stream_topic = "task-stream"
-tasks_topic = "tasks"
+async def refresh_periodically(refresh: Callable[[], Awaitable[None]], interval: float):
+    # Each worker process only sees some of the account events and its own
+    # task changes, so in-memory read models are also reloaded now and then
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh()
+        except Exception:
+            logging.exception("Failed to refresh in-memory read models")
 
-producer = AIOKafkaProducer(
-    bootstrap_servers=os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
-    value_serializer=lambda v: json.dumps(v, default=str).encode("utf-8"),
-)
 
-consumer = AIOKafkaConsumer(
-    "account-stream",
-    bootstrap_servers=os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
-    group_id="tasktracker",
-    value_deserializer=lambda v: json.loads(v.decode("utf-8")),
-)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Everything that binds to the event loop or opens connections is built
+    # here, once per worker process, instead of at import
+    await db.create_tables()
+    await warm_pool(db.engine)
 
+    authIdentityRepo = AuthIdentityRepository(db.AsyncSession)
+    accountRepo = AccountRepository(db.AsyncSession)
+    taskRepo = TaskRepository(db.AsyncSession)
 
-async def get_current_account(token: Annotated[str, Depends(oauth2_scheme)]):
-    return await authService.get_current_account(token)
+    workerRoster = WorkerRoster()
+    accountService = AccountService(accountRepo, workerRoster)
+    # Runs before the regular consumer joins its group, so that consumer
+    # starts from the offsets committed here. Other workers wait on the lock
+    # and then find the offsets already saved
+    bootstrap = AccountBootstrap(
+        accountService,
+        accountRepo,
+        os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
+        group_id="tasktracker",
+    )
+    async with db.advisory_lock(db.ACCOUNT_BOOTSTRAP_LOCK):
+        if await bootstrap.needed():
+            await bootstrap.run()
+    await accountService.warm_roster()
+
+    tokenCache = TTLCache(
+        max_size=int(os.environ.get("TOKEN_CACHE_MAX_SIZE", "10000")),
+        ttl=float(os.environ.get("TOKEN_CACHE_TTL_SECONDS", "300")),
+    )
+    authClient = httpx.AsyncClient(
+        timeout=float(os.environ.get("AUTH_CLIENT_TIMEOUT_SECONDS", "5")),
+        limits=httpx.Limits(
+            max_connections=int(os.environ.get("AUTH_CLIENT_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(
+                os.environ.get("AUTH_CLIENT_MAX_KEEPALIVE_CONNECTIONS", "20")
+            ),
+            keepalive_expiry=float(
+                os.environ.get("AUTH_CLIENT_KEEPALIVE_SECONDS", "30")
+            ),
+        ),
+    )
+    app.state.authService = AuthService(
+        accountRepo, authIdentityRepo, tokenCache, authClient, workerRoster
+    )
+    tasksService = TaskService(
+        taskRepo,
+        accountRepo,
+        workerRoster,
+        TaskAnalytics(),
+        create_assignment_strategy(workerRoster),
+    )
+    await tasksService.rebuild_analytics()
+    app.state.tasksService = tasksService
+
+    publisher = EventPublisher(os.environ.get("KAFKA_BOOTSTRAP_SERVERS"))
+    await publisher.start()
+    app.state.publisher = publisher
+
+    consumer = AIOKafkaConsumer(
+        bootstrap_servers=os.environ.get("KAFKA_BOOTSTRAP_SERVERS"),
+        group_id="tasktracker",
+        enable_auto_commit=False,
+        value_deserializer=decode_event,
+    )
+    await consumer.start()
+    accountConsumer = PartitionedConsumer(
+        consumer, accountService.on_account_events, publisher.dead_letter
+    )
+    consumer.subscribe(
+        ["account-stream"], listener=PartitionRebalanceListener(accountConsumer)
+    )
+    await accountConsumer.start()
 
+    identitySweeper = IdentitySweeper(authIdentityRepo, accountRepo)
+    await identitySweeper.start()
 
-async def consume():
-    async for message in consumer:
-        event = message.value
-        logging.info(f"Received event: {event}")
-        if event["event_type"] == "account_created":
-            await accountService.on_account_created(event["payload"])
-        elif event["event_type"] == "account_deleted":
-            await accountService.on_account_deleted(event["payload"])
-        elif event["event_type"] == "account_updated":
-            await accountService.on_account_updated(event["payload"])
+    readModelRefreshes = [
+        asyncio.create_task(refresh_periodically(refresh, interval))
+        for refresh, interval in (
+            (accountService.warm_roster, roster_refresh_seconds),
+            (tasksService.rebuild_analytics, analytics_refresh_seconds),
+        )
+        if interval > 0
+    ]
+
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        for refresh in readModelRefreshes:
+            refresh.cancel()
+            with suppress(asyncio.CancelledError):
+                await refresh
+        await identitySweeper.stop()
+        await accountConsumer.stop()
+        await consumer.stop()
+        await publisher.stop()
+        await authClient.aclose()
+
+
+def get_auth_service(request: Request) -> AuthService:
+    return request.app.state.authService
+
+
+def get_tasks_service(request: Request) -> TaskService:
+    return request.app.state.tasksService
+
+
+def get_publisher(request: Request) -> EventPublisher:
+    return request.app.state.publisher
+
+
+AuthServiceDep = Annotated[AuthService, Depends(get_auth_service)]
+TaskServiceDep = Annotated[TaskService, Depends(get_tasks_service)]
+PublisherDep = Annotated[EventPublisher, Depends(get_publisher)]
+
+router = APIRouter()
+
+tokenUrl = os.environ.get("AUTH_SERVICE_URL") + "/token"
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl=tokenUrl)
+
+
+async def get_current_account(
+    token: Annotated[str, Depends(oauth2_scheme)], authService: AuthServiceDep
+):
+    return await authService.get_current_account(token)
 
 
 def create_task_event(event_type: str, task: Task):
@@ -75,73 +202,176 @@ def create_task_event(event_type: str, task: Task):
     }
 
 
-class TaskReq(BaseModel):
-    title: str
-    description: str
+def publish_after_commit(publisher: EventPublisher, *events: tuple[str, dict, Any]):
+    # Events must not reach Kafka for changes that are then rolled back
+    after_commit(lambda: publisher.publish_later(list(events)))
 
 
-@app.on_event("startup")
-async def startup():
-    await producer.start()
-    await consumer.start()
-    asyncio.create_task(consume())
+def task_to_dict(task: Task):
+    # The JSON and NDJSON listings must render timestamps the same way
+    created_at = task.created_at.isoformat() if task.created_at else None
+    return {
+        "id": task.id,
+        "public_id": task.public_id,
+        "title": task.title,
+        "description": task.description,
+        "assigned_to": task.assigned_to,
+        "status": task.status.value,
+        "created_at": created_at,
+    }
 
 
-@app.on_event("shutdown")
-async def shutdown():
-    await producer.stop()
-    await consumer.stop()
+class TaskReq(BaseModel):
+    title: str
+    description: str
 
 
-@app.get("/")
-async def index(current_account: Annotated[Account, Depends(get_current_account)]):
-    tasks = await tasksService.get_tasks_for_account(current_account)
+@router.get("/")
+async def index(
+    current_account: Annotated[Account, Depends(get_current_account)],
+):
     return {"message": "Hello, World"}
 
 
-@app.post("/create_task")
+@router.post("/create_task")
 async def create_task(
     task: TaskReq,
     current_account: Annotated[Account, Depends(get_current_account)],
+    tasksService: TaskServiceDep,
+    publisher: PublisherDep,
 ):
     result = await tasksService.create_task(
         task.title, task.description, current_account
     )
-    producer.send_and_wait(
-        task_stream_topic, value=create_task_event("task_created", result)
-    )
-    producer.send_and_wait(
-        tasks_topic, value=create_task_event("task_assigned", result)
+    key = result.assigned_to
+    publish_after_commit(
+        publisher,
+        (task_stream_topic, create_task_event("task_created", result), key),
+        (tasks_topic, create_task_event("task_assigned", result), key),
     )
     return {"message": "Task created successfully"}
 
 
-@app.put("/shuffle")
+@router.put("/shuffle")
 async def shuffle_tasks(
-    current_account: Annotated[Account, Depends(get_current_account)]
+    current_account: Annotated[Account, Depends(get_current_account)],
+    tasksService: TaskServiceDep,
+    publisher: PublisherDep,
 ):
+    reassigned = 0
     try:
-        result = await tasksService.shuffle_tasks(current_account)
-        for task in result:
-            producer.send_and_wait(
-                tasks_topic, value=create_task_event("task_assigned", task)
-            )
-        return {"message": "Tasks shuffled successfully"}
-    except:
-        return HTTPException(status_code=400, detail="Only admin can shuffle tasks")
+        async for chunk in tasksService.shuffle_tasks(current_account):
+            # Every chunk is committed before it is yielded
+            for task in chunk:
+                await publisher.publish(
+                    tasks_topic,
+                    create_task_event("task_assigned", task),
+                    key=task.assigned_to,
+                )
+            reassigned += len(chunk)
+    except HTTPException:
+        raise
+    except Exception:
+        logging.exception("Shuffle failed")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Shuffle failed after reassigning {reassigned} tasks",
+        )
+    return {"message": "Tasks shuffled successfully", "reassigned": reassigned}
 
 
-@app.put("/complete_task")
+@router.get("/shuffle")
+async def shuffle_progress(
+    current_account: Annotated[Account, Depends(get_current_account)],
+    tasksService: TaskServiceDep,
+):
+    return await tasksService.get_shuffle_progress(current_account)
+
+
+@router.put("/complete_task")
 async def complete_task(
-    id: int, current_account: Annotated[Account, Depends(get_current_account)]
+    id: int,
+    current_account: Annotated[Account, Depends(get_current_account)],
+    tasksService: TaskServiceDep,
+    publisher: PublisherDep,
 ):
     result = await tasksService.complete_task(id, current_account)
-    producer.send_and_wait(
-        tasks_topic, value=create_task_event("task_completed", result)
+    publish_after_commit(
+        publisher,
+        (tasks_topic, create_task_event("task_completed", result), result.assigned_to),
     )
     return {"message": "Task completed successfully"}
 
 
-@app.get("/tasks")
-async def get_tasks(token: Annotated[str, Depends(oauth2_scheme)]):
-    return {"tasks": []}
+@router.get("/tasks")
+async def get_tasks(
+    current_account: Annotated[Account, Depends(get_current_account)],
+    tasksService: TaskServiceDep,
+    status: Optional[Status] = None,
+    assigned_to: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=500)] = 50,
+    stream: bool = False,
+):
+    if stream:
+        tasks = tasksService.stream_tasks_for_account(
+            current_account, status, assigned_to, cursor
+        )
+
+        async def ndjson():
+            async for task in tasks:
+                yield json.dumps(task_to_dict(task)) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    tasks, next_cursor = await tasksService.get_tasks_for_account(
+        current_account, status, assigned_to, cursor, limit
+    )
+    return {
+        "tasks": [task_to_dict(task) for task in tasks],
+        "next_cursor": next_cursor,
+    }
+
+
+@router.get("/analytics")
+async def get_analytics(
+    current_account: Annotated[Account, Depends(get_current_account)],
+    tasksService: TaskServiceDep,
+    assigned_to: Optional[int] = None,
+):
+    return {
+        "day": tasksService.analytics.day,
+        "workers": tasksService.get_analytics(current_account, assigned_to),
+    }
+
+
+@router.post("/analytics/rebuild")
+async def rebuild_analytics(
+    current_account: Annotated[Account, Depends(get_current_account)],
+    tasksService: TaskServiceDep,
+):
+    if current_account.role != "admin":
+        raise HTTPException(status_code=403, detail="Only admin can rebuild analytics")
+    await tasksService.rebuild_analytics()
+    return {
+        "message": "Analytics rebuilt",
+        "workers": len(tasksService.analytics.all()),
+    }
+
+
+@router.get("/db/pool")
+async def get_pool_stats():
+    return pool_stats(db.engine)
+
+
+@router.get("/metrics")
+async def metrics():
+    return metrics_response(db.engine)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan, dependencies=[Depends(request_unit_of_work)])
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(health_router)
+    app.include_router(router)
+    return app
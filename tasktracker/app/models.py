@@ -1,5 +1,14 @@
 from app.database import Base
-from sqlalchemy import Column, Integer, String, Enum as EnumColumn, ForeignKey, DateTime
+from sqlalchemy import (
+    Column,
+    Integer,
+    BigInteger,
+    String,
+    Enum as EnumColumn,
+    ForeignKey,
+    DateTime,
+    Index,
+)
 from enum import Enum
 import datetime
 import uuid
@@ -9,7 +18,9 @@ class Account(Base):
     __tablename__ = "accounts"
 
     id = Column(Integer, primary_key=True, index=True)
-    public_id = Column(String(50), unique=True, index=True, default=uuid.uuid4)
+    public_id = Column(
+        String(50), unique=True, index=True, default=lambda: str(uuid.uuid4())
+    )
     username = Column(String(50), unique=True, index=True)
     email = Column(String(50), unique=True, index=True, nullable=True)
     role = Column(String(50))
@@ -27,15 +38,21 @@ class Status(Enum):
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        Index("ix_tasks_assigned_to_status_id", "assigned_to", "status", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    public_id = Column(String(50), unique=True, index=True, default=uuid.uuid4)
+    public_id = Column(
+        String(50), unique=True, index=True, default=lambda: str(uuid.uuid4())
+    )
     title = Column(String(255))
     description = Column(String(100))
     account_id = Column(Integer)
     assigned_to = Column(Integer)
     status = Column(EnumColumn(Status), default=Status.CREATED)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    assigned_at = Column(DateTime, default=datetime.datetime.utcnow)
 
     foreign_key = Column(Integer, ForeignKey("accounts.id"))
 
@@ -46,8 +63,40 @@ class AuthIdentity(Base):
     id = Column(Integer, primary_key=True, index=True)
     account_id = Column(Integer)
     token = Column(String(255), index=True, unique=True)
-    expires_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(
         DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow
     )
+
+
+class ProcessedEvent(Base):
+    __tablename__ = "processed_events"
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String(50), unique=True, index=True)
+    processed_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+
+class ConsumerOffset(Base):
+    __tablename__ = "consumer_offsets"
+
+    topic = Column(String(100), primary_key=True)
+    partition = Column(Integer, primary_key=True)
+    offset = Column(BigInteger)
+    updated_at = Column(
+        DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow
+    )
+
+
+class ShuffleRun(Base):
+    __tablename__ = "shuffle_runs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    reassigned = Column(Integer, default=0)
+    error = Column(String(255), nullable=True)
+    started_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(
+        DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow
+    )
+    finished_at = Column(DateTime, nullable=True)
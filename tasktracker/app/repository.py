@@ -1,98 +1,397 @@
-from typing import Optional
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from sqlalchemy import Integer, bindparam, cast, delete, func, text, tuple_, update
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.future import select
-from app.models import AuthIdentity, Account, Task, Status
+from app.database import SHUFFLE_LOCK, SWEEP_LOCK
+from app.uow import Repository
+from app.metrics import instrument_repository
+from sqlalchemy.sql.elements import Grouping
+from app.models import (
+    AuthIdentity,
+    Account,
+    ConsumerOffset,
+    Task,
+    Status,
+    ProcessedEvent,
+    ShuffleRun,
+)
+import datetime
 
 
-class AuthIdentityRepository:
-    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
-        self.async_session = async_session
-
+@instrument_repository
+class AuthIdentityRepository(Repository):
     async def get_auth_identity_by_token(self, token: str) -> Optional[AuthIdentity]:
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(select(AuthIdentity).filter_by(token=token))
             return result.scalar()
 
     async def add_auth_identity(self, auth_identity: AuthIdentity) -> AuthIdentity:
-        async with self.async_session() as session:
+        async with self.session() as session:
             session.add(auth_identity)
-            await session.commit()
+            await self.commit(session)
             await session.refresh(auth_identity)
             return auth_identity
 
     async def delete_auth_identity(self, auth_identity: AuthIdentity) -> AuthIdentity:
-        async with self.async_session() as session:
+        async with self.session() as session:
             await session.delete(auth_identity)
-            await session.commit()
+            await self.commit(session)
             return auth_identity
 
+    @asynccontextmanager
+    async def sweep_lock(self) -> AsyncIterator[bool]:
+        # Held by a transaction that stays open for the whole sweep, so only
+        # one worker process sweeps at a time
+        async with self.async_session() as session:
+            if session.bind.dialect.name != "postgresql":
+                yield True
+                return
+            yield await session.scalar(
+                text("SELECT pg_try_advisory_xact_lock(:lock)"),
+                {"lock": SWEEP_LOCK},
+            )
+
+    async def delete_expired_auth_identities(
+        self, now: datetime.datetime, batch_size: int
+    ) -> int:
+        async with self.session() as session:
+            expired = (
+                select(AuthIdentity.id)
+                .where(AuthIdentity.expires_at < now)
+                .order_by(AuthIdentity.expires_at)
+                .limit(batch_size)
+            )
+            result = await session.execute(
+                delete(AuthIdentity)
+                .where(AuthIdentity.id.in_(expired.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            )
+            await self.commit(session)
+            return result.rowcount
+
+    async def count_expired_auth_identities(self, now: datetime.datetime) -> int:
+        async with self.session() as session:
+            result = await session.execute(
+                select(func.count())
+                .select_from(AuthIdentity)
+                .where(AuthIdentity.expires_at < now)
+            )
+            return result.scalar()
 
-class AccountRepository:
-    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
-        self.async_session = async_session
 
+@instrument_repository
+class AccountRepository(Repository):
     async def get_account_by_id(self, id: int) -> Optional[Account]:
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(select(Account).filter_by(id=id))
             return result.scalar()
 
     async def get_account_by_public_id(self, public_id: str) -> Optional[Account]:
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(
                 select(Account).filter_by(public_id=public_id)
             )
             return result.scalar()
 
     async def add_account(self, account: Account) -> Account:
-        async with self.async_session() as session:
+        async with self.session() as session:
             session.add(account)
-            await session.commit()
+            await self.commit(session)
             await session.refresh(account)
             return account
 
     async def get_accounts(self):
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(select(Account))
             return result.scalars().all()
 
     async def get_worker_accounts(self):
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(select(Account).filter_by(role="worker"))
             return result.scalars().all()
 
+    async def get_worker_ids(self) -> list[int]:
+        async with self.session() as session:
+            result = await session.execute(select(Account.id).filter_by(role="worker"))
+            return result.scalars().all()
+
+    async def get_processed_event_ids(self, event_ids: list[str]) -> set[str]:
+        async with self.session() as session:
+            result = await session.execute(
+                select(ProcessedEvent.event_id).where(
+                    ProcessedEvent.event_id.in_(event_ids)
+                )
+            )
+            return set(result.scalars().all())
+
+    async def delete_processed_events(
+        self, processed_before: datetime.datetime, batch_size: int
+    ) -> int:
+        async with self.session() as session:
+            expired = (
+                select(ProcessedEvent.id)
+                .where(ProcessedEvent.processed_at < processed_before)
+                .order_by(ProcessedEvent.processed_at)
+                .limit(batch_size)
+            )
+            result = await session.execute(
+                delete(ProcessedEvent)
+                .where(ProcessedEvent.id.in_(expired.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            )
+            await self.commit(session)
+            return result.rowcount
 
-class TaskRepository:
-    def __init__(self, async_session: async_sessionmaker[AsyncSession]):
-        self.async_session = async_session
+    async def apply_account_changes(
+        self, upserts: list[dict], deleted_public_ids: list[str], event_ids: list[str]
+    ) -> tuple[list, list[int]]:
+        upserted = []
+        deleted = []
+        async with self.session() as session:
+            if deleted_public_ids:
+                result = await session.execute(
+                    delete(Account)
+                    .where(Account.public_id.in_(deleted_public_ids))
+                    .returning(Account.id)
+                )
+                deleted = result.scalars().all()
+            if upserts:
+                stmt = insert(Account).values(upserts)
+                result = await session.execute(
+                    stmt.on_conflict_do_update(
+                        index_elements=[Account.public_id],
+                        set_={
+                            "username": stmt.excluded.username,
+                            "role": stmt.excluded.role,
+                            "updated_at": datetime.datetime.utcnow(),
+                        },
+                    ).returning(Account.id, Account.role)
+                )
+                upserted = result.all()
+            if event_ids:
+                await session.execute(
+                    insert(ProcessedEvent)
+                    .values([{"event_id": event_id} for event_id in event_ids])
+                    .on_conflict_do_nothing(index_elements=[ProcessedEvent.event_id])
+                )
+            await self.commit(session)
+        return upserted, deleted
 
+    async def get_consumer_offsets(self, topic: str) -> dict[int, int]:
+        async with self.session() as session:
+            result = await session.execute(
+                select(ConsumerOffset.partition, ConsumerOffset.offset).where(
+                    ConsumerOffset.topic == topic
+                )
+            )
+            return dict(result.all())
+
+    async def save_consumer_offsets(self, topic: str, offsets: dict[int, int]):
+        async with self.session() as session:
+            stmt = insert(ConsumerOffset).values(
+                [
+                    {"topic": topic, "partition": partition, "offset": offset}
+                    for partition, offset in offsets.items()
+                ]
+            )
+            await session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[ConsumerOffset.topic, ConsumerOffset.partition],
+                    set_={
+                        "offset": stmt.excluded.offset,
+                        "updated_at": datetime.datetime.utcnow(),
+                    },
+                )
+            )
+            await self.commit(session)
+
+
+@instrument_repository
+class TaskRepository(Repository):
     async def create_task(self, task: Task):
-        async with self.async_session() as session:
+        async with self.session() as session:
             session.add(task)
-            await session.commit()
+            await self.commit(session)
             await session.refresh(task)
             return task
 
-    async def get_incomplete_tasks(self):
+    @asynccontextmanager
+    async def shuffle_lock(self) -> AsyncIterator[bool]:
+        # Held by a transaction that stays open for the whole shuffle, so only
+        # one worker process shuffles at a time
+        async with self.async_session() as session:
+            if session.bind.dialect.name != "postgresql":
+                yield True
+                return
+            yield await session.scalar(
+                text("SELECT pg_try_advisory_xact_lock(:lock)"),
+                {"lock": SHUFFLE_LOCK},
+            )
+
+    async def start_shuffle_run(self) -> int:
+        async with self.async_session() as session:
+            # Runs left unfinished by a process that died are over
+            await session.execute(
+                update(ShuffleRun)
+                .where(ShuffleRun.finished_at.is_(None))
+                .values(finished_at=datetime.datetime.utcnow(), error="Interrupted")
+            )
+            run = ShuffleRun()
+            session.add(run)
+            await session.commit()
+            return run.id
+
+    async def update_shuffle_run(
+        self,
+        run_id: int,
+        reassigned: int,
+        finished: bool = False,
+        error: Optional[str] = None,
+    ):
+        values = {"reassigned": reassigned}
+        if finished:
+            values.update(finished_at=datetime.datetime.utcnow(), error=error)
         async with self.async_session() as session:
+            await session.execute(
+                update(ShuffleRun).where(ShuffleRun.id == run_id).values(**values)
+            )
+            await session.commit()
+
+    async def get_last_shuffle_run(self) -> Optional[ShuffleRun]:
+        async with self.session() as session:
+            result = await session.execute(
+                select(ShuffleRun).order_by(ShuffleRun.id.desc()).limit(1)
+            )
+            return result.scalar()
+
+    async def reassign_open_tasks(
+        self, worker_ids: list[int], chunk_size: int, balanced: bool = False
+    ):
+        workers = Grouping(bindparam("worker_ids", worker_ids, type_=ARRAY(Integer)))
+        last_id = 0
+        dealt = 0
+        while True:
+            # Every chunk is its own transaction, even inside a unit of work
+            async with self.async_session() as session:
+                # Selected separately so RETURNING can report the previous
+                # assignment alongside the new one
+                locked = (
+                    select(
+                        Task.id,
+                        Task.assigned_to.label("previous_assigned_to"),
+                        Task.assigned_at.label("previous_assigned_at"),
+                    )
+                    .where(Task.status == Status.ASSIGNED, Task.id > last_id)
+                    .order_by(Task.id)
+                    .limit(chunk_size)
+                    .with_for_update()
+                    .subquery()
+                )
+                # Window functions are not allowed next to FOR UPDATE, so rows
+                # are numbered outside the locking query
+                previous = select(
+                    locked,
+                    func.row_number().over(order_by=locked.c.id).label("position"),
+                ).subquery()
+                # Postgres arrays are 1-based
+                if balanced:
+                    # Deal tasks out in turn, continuing across chunks, so open
+                    # task counts end up at most one apart
+                    index = (previous.c.position + dealt - 1) % len(worker_ids)
+                else:
+                    # random() is evaluated per updated row
+                    index = func.floor(func.random() * len(worker_ids))
+                pick = workers[cast(index, Integer) + 1]
+                result = await session.execute(
+                    update(Task)
+                    .where(Task.id == previous.c.id)
+                    .values(assigned_to=pick, assigned_at=datetime.datetime.utcnow())
+                    .returning(
+                        Task.id,
+                        Task.public_id,
+                        Task.assigned_to,
+                        Task.assigned_at,
+                        Task.description,
+                        previous.c.previous_assigned_to,
+                        previous.c.previous_assigned_at,
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                rows = result.all()
+                await session.commit()
+            if not rows:
+                return
+            last_id = max(row.id for row in rows)
+            dealt += len(rows)
+            yield rows
+
+    async def get_task_counts(
+        self, since: datetime.datetime
+    ) -> list[tuple[int, int, int, int]]:
+        async with self.session() as session:
             result = await session.execute(
-                select(Task).filter_by(status=Status.ASSIGNED)
+                select(
+                    Task.assigned_to,
+                    func.count().filter(Task.status != Status.COMPLETED),
+                    func.count().filter(Task.status == Status.COMPLETED),
+                    func.count().filter(Task.assigned_at >= since),
+                )
+                .where(Task.assigned_to.is_not(None))
+                .group_by(Task.assigned_to)
+            )
+            return result.all()
+
+    def _tasks_for_assignee(
+        self,
+        assigned_to: int,
+        status: Optional[Status],
+        after: Optional[tuple[Status, int]],
+    ):
+        query = select(Task).where(Task.assigned_to == assigned_to)
+        if status is not None:
+            query = query.where(Task.status == status)
+        if after is not None:
+            query = query.where(tuple_(Task.status, Task.id) > after)
+        return query.order_by(Task.status, Task.id)
+
+    async def get_tasks_page(
+        self,
+        assigned_to: int,
+        status: Optional[Status],
+        after: Optional[tuple[Status, int]],
+        limit: int,
+    ) -> list[Task]:
+        async with self.session() as session:
+            result = await session.execute(
+                self._tasks_for_assignee(assigned_to, status, after).limit(limit)
             )
             return result.scalars().all()
 
-    async def update_tasks(self, tasks: list[Task]):
+    async def stream_tasks(
+        self,
+        assigned_to: int,
+        status: Optional[Status],
+        after: Optional[tuple[Status, int]],
+        batch_size: int = 500,
+    ):
         async with self.async_session() as session:
-            session.bulk_save_objects(tasks)
-            await session.commit()
-            return tasks
+            result = await session.stream_scalars(
+                self._tasks_for_assignee(assigned_to, status, after).execution_options(
+                    yield_per=batch_size
+                )
+            )
+            async for task in result:
+                yield task
 
     async def get_task_by_id(self, id: int) -> Optional[Task]:
-        async with self.async_session() as session:
+        async with self.session() as session:
             result = await session.execute(select(Task).filter_by(id=id))
             return result.scalar()
 
     async def update_task(self, task: Task) -> Task:
-        async with self.async_session() as session:
+        async with self.session() as session:
             session.add(task)
-            await session.commit()
+            await self.commit(session)
             await session.refresh(task)
             return task
@@ -0,0 +1,53 @@
+from typing import Iterable, Optional
+import random
+
+
+class WorkerRoster:
+    def __init__(self):
+        self._ids: list[int] = []
+        self._positions: dict[int, int] = {}
+        # Bumped on every membership change, for indexes kept alongside
+        self.version = 0
+
+    def replace(self, account_ids: Iterable[int]):
+        self._ids = list(dict.fromkeys(account_ids))
+        self._positions = {account_id: i for i, account_id in enumerate(self._ids)}
+        self.version += 1
+
+    def add(self, account_id: int):
+        if account_id in self._positions:
+            return
+        self._positions[account_id] = len(self._ids)
+        self._ids.append(account_id)
+        self.version += 1
+
+    def remove(self, account_id: int):
+        position = self._positions.pop(account_id, None)
+        if position is None:
+            return
+        self.version += 1
+        # Move the last worker into the freed slot to keep removal O(1)
+        last = self._ids.pop()
+        if position < len(self._ids):
+            self._ids[position] = last
+            self._positions[last] = position
+
+    def on_account_changed(self, account_id: int, role: Optional[str]):
+        if role == "worker":
+            self.add(account_id)
+        else:
+            self.remove(account_id)
+
+    def pick(self) -> Optional[int]:
+        if not self._ids:
+            return None
+        return random.choice(self._ids)
+
+    def ids(self) -> list[int]:
+        return list(self._ids)
+
+    def __contains__(self, account_id: int) -> bool:
+        return account_id in self._positions
+
+    def __len__(self) -> int:
+        return len(self._ids)
@@ -0,0 +1,13 @@
+import jwt
+import os
+
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = "HS256"
+
+
+def decode_access_token(token: str) -> dict:
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+
+def can_verify_locally() -> bool:
+    return bool(SECRET_KEY)
@@ -1,22 +1,52 @@
+from typing import Optional
 from fastapi import HTTPException, status
 from app.repository import TaskRepository, AccountRepository, AuthIdentityRepository
 from app.models import Account, Task, Status, AuthIdentity
-from datetime import datetime
+from app.cache import TTLCache
+from app.security import decode_access_token, can_verify_locally
+from app.singleflight import SingleFlight
+from app.roster import WorkerRoster
+from app.analytics import TaskAnalytics
+from app.assignment import AssignmentStrategy
+from app.uow import after_commit, after_rollback
+from datetime import datetime, time
 import httpx
-import random
-import asyncio
+import base64
+import logging
 import os
-import httpx
+
+
+def encode_cursor(task: Task) -> str:
+    return base64.urlsafe_b64encode(f"{task.status.name}:{task.id}".encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple[Status, int]]:
+    if not cursor:
+        return None
+    try:
+        status_name, id = base64.urlsafe_b64decode(cursor).decode().split(":")
+        return Status[status_name], int(id)
+    except (ValueError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 class AuthService:
     verify_url = os.environ.get("AUTH_SERVICE_URL") + "/verify"
 
     def __init__(
-        self, account_repo: AccountRepository, identity_repo: AuthIdentityRepository
+        self,
+        account_repo: AccountRepository,
+        identity_repo: AuthIdentityRepository,
+        token_cache: TTLCache,
+        http_client: httpx.AsyncClient,
+        roster: WorkerRoster,
     ):
         self.account_repo = account_repo
         self.identity_repo = identity_repo
+        self.token_cache = token_cache
+        self.http_client = http_client
+        self.roster = roster
+        self.inflight = SingleFlight()
 
     async def get_current_account(self, token: str):
         credentials_exception = HTTPException(
@@ -25,86 +55,259 @@ class AuthService:
             headers={"WWW-Authenticate": "Bearer"},
         )
         try:
-            authIdentity = await self.identity_repo.get_auth_identity_by_token(token)
-            if not authIdentity:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        self.verify_url,
-                        headers={"Authorization": f"Bearer {token}"},
-                    )
-                    if response.status_code == 200:
-                        account_id = response.json().get("account_id")
-                        account = await self.account_repo.get_account_by_public_id(
-                            account_id
-                        )
-                        if not account:
-                            account = Account(
-                                public_id=account_id,
-                                role=response.json().get("role"),
-                                username=response.json().get("username"),
-                            )
-                            account = await self.account_repo.add_account(account)
-                            print(account)
-                        authIdentity = await self.identity_repo.add_auth_identity(
-                            AuthIdentity(
-                                token=token,
-                                account_id=account.id,
-                                expires_at=datetime.fromtimestamp(
-                                    response.json().get("expires_at")
-                                ),
-                            )
-                        )
-                        return account
-                raise credentials_exception
-            if authIdentity.expires_at < datetime.now():
-                await self.identity_repo.delete_auth_identity(authIdentity)
+            claims = self.token_cache.get(token)
+            if claims is None and can_verify_locally():
+                claims = decode_access_token(token)
+                self.token_cache.set(token, claims, expires_at=claims.get("exp"))
+            if claims is not None:
+                account = await self.account_repo.get_account_by_public_id(
+                    claims.get("sub")
+                )
+                if account:
+                    return account
+            account = await self.inflight.do(token, lambda: self.verify_remotely(token))
+            if not account:
                 raise credentials_exception
-            return await self.account_repo.get_account_by_id(authIdentity.account_id)
+            return account
         except:
             raise credentials_exception
 
+    async def verify_remotely(self, token: str) -> Optional[Account]:
+        authIdentity = await self.identity_repo.get_auth_identity_by_token(token)
+        if authIdentity:
+            if authIdentity.expires_at < datetime.now():
+                await self.identity_repo.delete_auth_identity(authIdentity)
+                return None
+            account = await self.account_repo.get_account_by_id(authIdentity.account_id)
+            if account:
+                self.cache_claims(
+                    token, account.public_id, account.role, authIdentity.expires_at
+                )
+            return account
+
+        response = await self.http_client.get(
+            self.verify_url,
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        if response.status_code != 200:
+            return None
+        account_id = response.json().get("account_id")
+        account = await self.account_repo.get_account_by_public_id(account_id)
+        if not account:
+            account = Account(
+                public_id=account_id,
+                role=response.json().get("role"),
+                username=response.json().get("username"),
+            )
+            account = await self.account_repo.add_account(account)
+            self.roster.on_account_changed(account.id, account.role)
+        expires_at = datetime.fromtimestamp(response.json().get("expires_at"))
+        await self.identity_repo.add_auth_identity(
+            AuthIdentity(token=token, account_id=account.id, expires_at=expires_at)
+        )
+        self.cache_claims(token, account.public_id, account.role, expires_at)
+        return account
+
+    def cache_claims(self, token: str, public_id: str, role: str, expires_at: datetime):
+        exp = expires_at.timestamp()
+        self.token_cache.set(
+            token, {"sub": public_id, "role": role, "exp": exp}, expires_at=exp
+        )
+
 
 class TaskService:
-    def __init__(self, task_repo: TaskRepository, account_repo: AccountRepository):
+    shuffle_chunk_size = int(os.environ.get("SHUFFLE_CHUNK_SIZE", "1000"))
+
+    def __init__(
+        self,
+        task_repo: TaskRepository,
+        account_repo: AccountRepository,
+        roster: WorkerRoster,
+        analytics: TaskAnalytics,
+        assignment: AssignmentStrategy,
+    ):
         self.task_repo = task_repo
         self.account_repo = account_repo
+        self.roster = roster
+        self.analytics = analytics
+        self.assignment = assignment
+        # Guards this process, shuffle_lock() guards the others
+        self.shuffling = False
+
+    def tasks_assignee(self, account: Account, assigned_to: Optional[int]) -> int:
+        if assigned_to is None or assigned_to == account.id:
+            return account.id
+        if account.role not in ("admin", "manager"):
+            raise HTTPException(
+                status_code=403, detail="Only admin or manager can list other tasks"
+            )
+        return assigned_to
+
+    async def get_tasks_for_account(
+        self,
+        account: Account,
+        status: Optional[Status] = None,
+        assigned_to: Optional[int] = None,
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> tuple[list[Task], Optional[str]]:
+        tasks = await self.task_repo.get_tasks_page(
+            self.tasks_assignee(account, assigned_to),
+            status,
+            decode_cursor(cursor),
+            limit,
+        )
+        next_cursor = encode_cursor(tasks[-1]) if len(tasks) == limit else None
+        return tasks, next_cursor
 
-    async def get_tasks_for_account(self, account: Account):
-        pass
+    def stream_tasks_for_account(
+        self,
+        account: Account,
+        status: Optional[Status] = None,
+        assigned_to: Optional[int] = None,
+        cursor: Optional[str] = None,
+    ):
+        # Validate before the response starts streaming
+        assignee = self.tasks_assignee(account, assigned_to)
+        return self.task_repo.stream_tasks(assignee, status, decode_cursor(cursor))
 
     async def create_task(self, title: str, description: str, account: Account):
-        task = Task(title=title, description=description)
-        accounts = await self.account_repo.get_accounts()
-        assignee = random.choice(accounts)
-        task.assigned_to = assignee.id
-        await self.task_repo.create_task(task)
+        # The picked worker is already charged with the task
+        assignee_id = self.assignment.pick()
+        if assignee_id is None:
+            raise HTTPException(status_code=409, detail="No workers to assign to")
+        task = Task(
+            title=title,
+            description=description,
+            assigned_to=assignee_id,
+            status=Status.ASSIGNED,
+        )
+        try:
+            await self.task_repo.create_task(task)
+        except Exception:
+            self.assignment.task_unassigned(assignee_id)
+            raise
+        # The unit of work may still fail to commit the task
+        after_rollback(lambda: self.assignment.task_unassigned(assignee_id))
+        after_commit(
+            lambda: self.analytics.task_assigned(assignee_id, task.assigned_at)
+        )
         return task
 
     async def shuffle_tasks(self, account: Account):
         if account.role != "admin":
-            raise Exception("Only admin can shuffle tasks")
-        tasks = await self.task_repo.get_incomplete_tasks()
-        accounts = await self.account_repo.get_worker_accounts()
-        for task in tasks:
-            assignee = random.choice(accounts)
-            task.assigned_to = assignee.id
-        await self.task_repo.update_tasks(tasks)
-        return tasks
+            raise HTTPException(status_code=403, detail="Only admin can shuffle tasks")
+        worker_ids = self.roster.ids()
+        if not worker_ids:
+            return
+        async with self.task_repo.shuffle_lock() as acquired:
+            if not acquired or self.shuffling:
+                raise HTTPException(
+                    status_code=409, detail="Shuffle is already running"
+                )
+            self.shuffling = True
+            run_id = await self.task_repo.start_shuffle_run()
+            reassigned = 0
+            error = None
+            try:
+                async for chunk in self.task_repo.reassign_open_tasks(
+                    worker_ids,
+                    self.shuffle_chunk_size,
+                    balanced=self.assignment.balanced_shuffle,
+                ):
+                    # Chunks are already committed
+                    for task in chunk:
+                        if task.previous_assigned_to is not None:
+                            self.assignment.task_unassigned(task.previous_assigned_to)
+                        self.assignment.task_assigned(task.assigned_to)
+                        self.analytics.task_reassigned(
+                            task.previous_assigned_to,
+                            task.previous_assigned_at,
+                            task.assigned_to,
+                            task.assigned_at,
+                        )
+                    reassigned += len(chunk)
+                    # Kept in the database so every worker process reports it
+                    await self.task_repo.update_shuffle_run(run_id, reassigned)
+                    logging.info(f"Shuffle reassigned {reassigned} tasks")
+                    yield chunk
+            except Exception as e:
+                error = str(e)[:255] or type(e).__name__
+                raise
+            finally:
+                self.shuffling = False
+                try:
+                    await self.task_repo.update_shuffle_run(
+                        run_id, reassigned, finished=True, error=error
+                    )
+                except Exception:
+                    logging.exception("Failed to record the end of a shuffle")
+
+    async def get_shuffle_progress(self, account: Account) -> dict:
+        if account.role != "admin":
+            raise HTTPException(status_code=403, detail="Only admin can shuffle tasks")
+        run = await self.task_repo.get_last_shuffle_run()
+        if run is None:
+            return {"running": False, "reassigned": 0}
+        return {
+            "running": run.finished_at is None,
+            "reassigned": run.reassigned,
+            "started_at": run.started_at,
+            "updated_at": run.updated_at,
+            "finished_at": run.finished_at,
+            "error": run.error,
+        }
 
     async def complete_task(self, id: int, account: Account):
         task = await self.task_repo.get_task_by_id(id)
         if not task:
-            raise Exception("Task not found")
+            raise HTTPException(status_code=404, detail="Task not found")
         if task.assigned_to != account.id:
-            raise Exception("Task is not assigned to you")
+            raise HTTPException(status_code=403, detail="Task is not assigned to you")
+        if task.status == Status.COMPLETED:
+            # A repeat would publish another task_completed for the same task
+            raise HTTPException(status_code=409, detail="Task is already completed")
         task.status = Status.COMPLETED
         await self.task_repo.update_task(task)
+        after_commit(lambda: self.analytics.task_completed(task.assigned_to))
+        after_commit(lambda: self.assignment.task_unassigned(task.assigned_to))
         return task
 
+    async def rebuild_analytics(self):
+        day = datetime.utcnow().date()
+        self.analytics.begin_rebuild()
+        self.assignment.begin_rebuild()
+        try:
+            counts = await self.task_repo.get_task_counts(
+                datetime.combine(day, time.min)
+            )
+        except BaseException:
+            self.analytics.abort_rebuild()
+            self.assignment.abort_rebuild()
+            raise
+        self.analytics.replace(counts, day)
+        # Assignments made by other worker processes show up here
+        self.assignment.replace(
+            {worker_id: open_count for worker_id, open_count, *_ in counts}
+        )
+
+    def get_analytics(self, account: Account, assigned_to: Optional[int] = None):
+        if account.role not in ("admin", "manager"):
+            raise HTTPException(
+                status_code=403, detail="Only admin or manager can view analytics"
+            )
+        if assigned_to is not None:
+            return {assigned_to: self.analytics.for_worker(assigned_to)}
+        return self.analytics.all()
+
 
 class AccountService:
-    def __init__(self, account_repo: AccountRepository):
+    def __init__(self, account_repo: AccountRepository, roster: WorkerRoster):
         self.account_repo = account_repo
+        self.roster = roster
+
+    async def warm_roster(self):
+        self.roster.replace(await self.account_repo.get_worker_ids())
 
     async def on_account_created(self, event):
         account = Account(
@@ -124,6 +327,47 @@ class AccountService:
         account.role = event["role"]
         await self.account_repo.update_account(account)
 
+    async def on_account_events(self, events: list[dict]):
+        event_ids = list({event["event_id"]: None for event in events})
+        processed = await self.account_repo.get_processed_event_ids(event_ids)
+        latest = {}
+        for event in events:
+            if event["event_id"] in processed:
+                continue
+            # Only the last change of an account within a batch matters
+            latest[event["payload"]["account_id"]] = event
+        if not latest:
+            return
+        new_event_ids = [
+            event_id for event_id in event_ids if event_id not in processed
+        ]
+        await self.apply_latest_account_states(latest, new_event_ids)
+
+    async def apply_latest_account_states(
+        self, latest: dict[str, Optional[dict]], event_ids: list[str]
+    ):
+        # A missing event (a compacted tombstone) deletes the account too
+        upserts = []
+        deleted_public_ids = []
+        for public_id, event in latest.items():
+            if event is None or event["event_type"] == "account_deleted":
+                deleted_public_ids.append(public_id)
+            elif event["event_type"] in ("account_created", "account_updated"):
+                upserts.append(
+                    {
+                        "public_id": public_id,
+                        "username": event["payload"]["username"],
+                        "role": event["payload"]["role"],
+                    }
+                )
+        upserted, deleted = await self.account_repo.apply_account_changes(
+            upserts, deleted_public_ids, event_ids
+        )
+        for account_id in deleted:
+            self.roster.remove(account_id)
+        for account_id, role in upserted:
+            self.roster.on_account_changed(account_id, role)
+
     async def get_account_by_public_id(self, public_id: str):
         return await self.account_repo.get_account_by_public_id(public_id)
 
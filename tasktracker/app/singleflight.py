@@ -0,0 +1,31 @@
+from typing import Any, Awaitable, Callable, Hashable
+import asyncio
+import contextvars
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._calls.get(key)
+        if future is None:
+            # Run outside the first caller's context so the shared call does not
+            # join its request-scoped session
+            future = asyncio.get_running_loop().create_task(
+                fn(), context=contextvars.Context()
+            )
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # A cancelled waiter must not cancel the call the others are waiting on
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved when every waiter went away
+            future.exception()
+
+    def __len__(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,120 @@
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Optional
+from prometheus_client import Counter, Gauge
+from app.repository import AccountRepository, AuthIdentityRepository
+import asyncio
+import logging
+import os
+
+AUTH_IDENTITIES_SWEPT = Counter(
+    "auth_identities_swept_total", "Expired auth identities deleted by the sweeper"
+)
+AUTH_IDENTITIES_EXPIRED = Gauge(
+    "auth_identities_expired", "Expired auth identities waiting to be swept"
+)
+PROCESSED_EVENTS_PRUNED = Counter(
+    "processed_events_pruned_total", "Processed event ids deleted by the sweeper"
+)
+
+SWEEP_BATCH_SIZE = int(os.getenv("AUTH_IDENTITY_SWEEP_BATCH_SIZE", "1000"))
+SWEEP_INTERVAL = float(os.getenv("AUTH_IDENTITY_SWEEP_INTERVAL_SECONDS", "60"))
+SWEEP_BATCH_PAUSE = float(os.getenv("AUTH_IDENTITY_SWEEP_BATCH_PAUSE_SECONDS", "0.1"))
+# Redeliveries come from uncommitted offsets, long after those the ids of
+# processed account events are no longer needed to drop duplicates
+PROCESSED_EVENT_RETENTION = float(
+    os.getenv("PROCESSED_EVENT_RETENTION_SECONDS", str(7 * 24 * 3600))
+)
+
+
+class IdentitySweeper:
+    def __init__(
+        self,
+        identity_repo: AuthIdentityRepository,
+        account_repo: AccountRepository,
+        batch_size: int = SWEEP_BATCH_SIZE,
+        interval: float = SWEEP_INTERVAL,
+        batch_pause: float = SWEEP_BATCH_PAUSE,
+        processed_event_retention: float = PROCESSED_EVENT_RETENTION,
+    ):
+        self.identity_repo = identity_repo
+        self.account_repo = account_repo
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batch_pause = batch_pause
+        self.processed_event_retention = processed_event_retention
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+
+    async def run(self):
+        while True:
+            try:
+                async with self.identity_repo.sweep_lock() as acquired:
+                    # Every worker process runs a sweeper, the ones that miss
+                    # the lock skip this interval
+                    if acquired:
+                        await self.sweep_all()
+            except Exception:
+                logging.exception("Failed to take the sweep lock")
+            await asyncio.sleep(self.interval)
+
+    async def sweep_all(self):
+        try:
+            await self.sweep()
+        except Exception:
+            logging.exception("Failed to sweep expired auth identities")
+        try:
+            await self.prune_processed_events()
+        except Exception:
+            logging.exception("Failed to prune processed event ids")
+
+    async def sweep(self) -> int:
+        now = datetime.now()
+        started = asyncio.get_running_loop().time()
+        swept = 0
+        while True:
+            deleted = await self.identity_repo.delete_expired_auth_identities(
+                now, self.batch_size
+            )
+            swept += deleted
+            AUTH_IDENTITIES_SWEPT.inc(deleted)
+            if deleted < self.batch_size:
+                break
+            # Short batches with a pause between them keep row locks and
+            # pool connections free for token lookups
+            await asyncio.sleep(self.batch_pause)
+        backlog = await self.identity_repo.count_expired_auth_identities(datetime.now())
+        AUTH_IDENTITIES_EXPIRED.set(backlog)
+        if swept:
+            elapsed = asyncio.get_running_loop().time() - started
+            logging.info(
+                f"Swept {swept} expired auth identities in {elapsed:.2f}s, "
+                f"{backlog} left"
+            )
+        return swept
+
+    async def prune_processed_events(self) -> int:
+        processed_before = datetime.utcnow() - timedelta(
+            seconds=self.processed_event_retention
+        )
+        pruned = 0
+        while True:
+            deleted = await self.account_repo.delete_processed_events(
+                processed_before, self.batch_size
+            )
+            pruned += deleted
+            PROCESSED_EVENTS_PRUNED.inc(deleted)
+            if deleted < self.batch_size:
+                break
+            await asyncio.sleep(self.batch_pause)
+        if pruned:
+            logging.info(f"Pruned {pruned} processed event ids")
+        return pruned
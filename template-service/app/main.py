@@ -0,0 +1,82 @@
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, Request, Response
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.engine import create_engine, pool_stats, warm_pool
+import os
+
+
+# Get the database connection configuration from environment variables
+db_user = os.getenv("POSTGRES_USER")
+db_password = os.getenv("POSTGRES_PASSWORD")
+db_host = os.getenv("POSTGRES_HOST")
+db_port = os.getenv("POSTGRES_PORT")
+db_name = os.getenv("POSTGRES_DB")
+
+# Create the database connection URL
+db_url = f"postgresql+psycopg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+
+# Create the SQLAlchemy engine
+engine = create_engine(db_url)
+
+# Create a session factory
+AsyncSession = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start Kafka clients and other loop-bound resources here, per worker
+    await warm_pool(engine)
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+
+
+router = APIRouter()
+
+# Define your routes and endpoints here
+
+
+@router.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+async def readyz(request: Request, response: Response):
+    if not getattr(request.app.state, "ready", False):
+        response.status_code = 503
+        return {"status": "not ready"}
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    return {"status": "ok"}
+
+
+# Example route
+@router.get("/")
+def read_root():
+    return {"Hello": "World"}
+
+
+@router.get("/db/pool")
+def get_pool_stats():
+    return pool_stats(engine)
+
+
+# Example route that uses the database connection
+@router.get("/users")
+async def get_users():
+    # Open a new session, it is closed when the block ends
+    async with AsyncSession() as session:
+        # Perform database operations here
+        pass
+
+    return {"message": "Users retrieved successfully"}
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    return app